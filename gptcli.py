@@ -1,35 +1,49 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import sys
 import enum
 import json
-import httpx
+import array
+import stat
+import time
+import random
+import sqlite3
+import hashlib
 import inspect
 import argparse
+import importlib.util
 import datetime
-import requests
+import itertools
+import threading
 from functools import partial
+from concurrent import futures
+from collections import OrderedDict, deque
+from collections.abc import MutableSequence
 from argparse import Namespace
-from typing import List
+from typing import List, TYPE_CHECKING
 
-from rich.console import Console
-from rich.markdown import Markdown
-from rich.live import Live
-from rich.table import Table
-from rich.spinner import Spinner
+from rich.console import Console, Group
+from rich.text import Text
 
+# only the interactive console uses cmd2, -q, raw, batch and serve mode never set it up
 import cmd2
 from cmd2 import argparse_custom, with_argparser, Settable
 
-import openai
+# NOTE: heavy modules like openai, httpx, requests, tiktoken and most of rich
+# are imported where they are used, to keep startup fast.
+if TYPE_CHECKING:
+    import openai
+    from rich.live import Live
 
 class ContextLevel(enum.Enum):
     NONE = 0
     REQUEST = 1
     FULL =  2
+    BUDGET = 3
 
 class Config:
-    sep = Markdown("---")
     baseDir = os.path.dirname(os.path.realpath(__file__))
     default = os.path.join(baseDir, "conf", "config.json")
     mdSep = '\n\n' + '-' * 10 + '\n'
@@ -44,19 +58,88 @@ class Config:
         with open(file, "r") as f:
             self.cfg = json.load(f)
         c: dict = self.cfg
-        self.api_key = c.get("api_key") or openai.api_key
-        self.base_url = c.get("base_url") or openai.base_url
+        self.api_key = c.get("api_key") or os.environ.get("OPENAI_API_KEY")
+        self.base_url = c.get("base_url") or os.environ.get("OPENAI_BASE_URL")
         self.model = c.get("model", "gpt-3.5-turbo")
         self.prompt = c.get("prompt", [])
         self.stream = c.get("stream", False)
         self.stream_render = c.get("stream_render", False)
+        self.stream_fps = c.get("stream_fps", 20)
         self.context = ContextLevel(c.get("context", 0))
         self.proxy = c.get("proxy", "")
         self.showtokens = c.get("showtokens", False)
         self.model_choices = c.get("model_choices", [])
+        self.http2 = c.get("http2", False)
+        self.timeout = c.get("timeout", 600)
+        self.connect_timeout = c.get("connect_timeout", 10)
+        self.max_connections = c.get("max_connections", 10)
+        self.max_keepalive = c.get("max_keepalive", 5)
+        self.keepalive_expiry = c.get("keepalive_expiry", 60)
+        self.prewarm = c.get("prewarm", True)
+        self.token_cache_size = c.get("token_cache_size", 4096)
+        self.tokenizers = c.get("tokenizers", {})
+        self.tokenizer_cache = os.path.expanduser(c.get("tokenizer_cache", ""))
+        self.context_budget = c.get("context_budget", 4096)
+        self.cache = c.get("cache", False)
+        self.cache_file = os.path.expanduser(c.get("cache_file", "~/.gptcli_cache.db"))
+        self.cache_ttl = c.get("cache_ttl", 7 * 24 * 3600)
+        self.cache_size = c.get("cache_size", 1000)
+        self.journal = c.get("journal", "")
+        self.journal_cache = c.get("journal_cache", 1024)
+        self.metrics_window = c.get("metrics_window", 200)
+        self.metrics_file = os.path.expanduser(c.get("metrics_file", ""))
+        self.endpoints = c.get("endpoints", [])
+        self.hedge = c.get("hedge", False)
+        self.hedge_percentile = c.get("hedge_percentile", 0.9)
+        self.failover_cooldown = c.get("failover_cooldown", 30)
+        self.rate_limit = c.get("rate_limit", True)
+        self.retries = c.get("retries", 3)
+        self.retry_backoff = c.get("retry_backoff", 1.0)
+        self.index_dir = os.path.expanduser(c.get("index_dir", "~/.gptcli_index"))
+        self.embedding_model = c.get("embedding_model", "text-embedding-3-small")
+        self.index_chunk = c.get("index_chunk", 1500)
+        self.index_batch = c.get("index_batch", 64)
+        self.compact = c.get("compact", False)
+        self.compact_threshold = c.get("compact_threshold", 4000)
+        self.compact_keep = c.get("compact_keep", 1500)
+        self.compact_model = c.get("compact_model", "")
+        self.jobs_workers = c.get("jobs_workers", 2)
+        self.jobs_queue = c.get("jobs_queue", 8)
+        self.session_memory = c.get("session_memory", 64)
+        self.file_concurrency = c.get("file_concurrency", 4)
+        self.search_file = os.path.expanduser(c.get("search_file", "~/.gptcli_search.db"))
+        self.search_dirs = c.get("search_dirs", [])
+        self.serve_client_limit = c.get("serve_client_limit", 4)
+        self.usage_file = os.path.expanduser(c.get("usage_file", "~/.gptcli_usage.db"))
 
     def get(self, key, default=None):
         return self.cfg.get(key, default)
+
+    @staticmethod
+    def read_prompt(file) -> list:
+        """Read prompt messages from plaintext or json file"""
+        prompt = []
+        if file.endswith(".json"):
+            with open(file, "r") as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                prompt.extend(data)
+            elif isinstance(data, dict):
+                prompt.append(data)
+        else:
+            with open(file, "r") as f:
+                data = f.read().rstrip()
+            prompt.append(
+                { "role": "system", "content": data }
+            )
+        return prompt
+
+    def get_budget(self) -> int:
+        """context_budget can be a number or a mapping of model to number"""
+        budget = self.context_budget
+        if isinstance(budget, dict):
+            return budget.get(self.model, budget.get("default", 4096))
+        return budget
     
     def __str__(self):
         mk = self.api_key[:7] + "*" * 5
@@ -65,12 +148,2771 @@ class Config:
         s += f"model={self.model}\n"
         if self.proxy:
             s += f"proxy={self.proxy}\n"
+        if self.endpoints:
+            s += f"Fallback endpoints: {len(self.endpoints)}\n"
         s += f"Context level: {self.context}\n"
         s += f"Stream mode: {self.stream}"
         return s
 
 
-class GptCli(cmd2.Cmd):
+class ApproxEncoding:
+    """
+    Fast token estimate for models without a local tokenizer: words are cut
+    into pieces of up to 6 letters with their leading space, like BPE merges,
+    and other characters count as one piece each. The estimate is multiplied
+    by `scale`, which is calibrated against the usage returned by the API.
+    """
+    name = "approx"
+    piece_re = re.compile(r" ?[A-Za-z]{1,6}| ?\d{1,3}|\s+|.", re.S)
+
+    def __init__(self, scale=1.0):
+        self.scale = scale
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return self.piece_re.findall(text)
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
+
+
+class TokenCounter:
+    """
+    Count tokens of messages. Encoders are resolved once per model: the
+    `tokenizers` mapping of model patterns to tiktoken encodings (or
+    "approx"), then the tiktoken encoding of known OpenAI models, and an
+    ApproxEncoding for any other model. tiktoken encodings are loaded in
+    background, as they may be downloaded on first use, the estimate is used
+    until then or if loading fails.
+
+    Counts are cached by encoding and content hash with LRU eviction, so only
+    new messages are encoded.
+    """
+    def __init__(self, size=4096, tokenizers=None):
+        self.size = size
+        self.tokenizers = tokenizers or {}
+        self.encoders = {}
+        self.approx = {}     # model -> ApproxEncoding
+        self.loaded = {}     # tiktoken encoding name -> encoding, or error message
+        self.accuracy = {}   # model -> [samples, sum of relative errors]
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, model: str):
+        """Return the tiktoken encoding name of model, None if it has none"""
+        import fnmatch
+        for pattern, name in self.tokenizers.items():
+            if fnmatch.fnmatch(model, pattern):
+                return None if name == "approx" else name
+        import tiktoken.model
+        try:
+            return tiktoken.model.encoding_name_for_model(model)
+        except KeyError:
+            return None
+
+    def load(self, name: str):
+        import tiktoken
+        try:
+            self.loaded[name] = tiktoken.get_encoding(name)
+        except Exception as e: # network, cache or unknown encoding errors
+            self.loaded[name] = f"{type(e).__name__}: {e}"
+
+    def encoder(self, model: str):
+        enc = self.encoders.get(model)
+        if enc is not None:
+            return enc
+        name = self.resolve(model)
+        with self.lock:
+            loaded = self.loaded.get(name)
+            if name and name not in self.loaded:
+                self.loaded[name] = "loading"
+                threading.Thread(target=self.load, args=(name,), daemon=True).start()
+            approx = self.approx.setdefault(model, ApproxEncoding())
+        if name is None or isinstance(loaded, str) and loaded != "loading":
+            self.encoders[model] = approx
+            return approx
+        if loaded is None or isinstance(loaded, str):
+            return approx
+        self.encoders[model] = loaded
+        return loaded
+
+    def count(self, model: str, text: str) -> int:
+        enc = self.encoder(model)
+        key = (enc.name, hashlib.blake2b(text.encode(), digest_size=16).digest())
+        with self.lock:
+            num = self.cache.get(key)
+            if num is not None:
+                self.cache.move_to_end(key)
+        if num is None:
+            num = len(enc.encode(text, disallowed_special=()))
+            with self.lock:
+                self.cache[key] = num
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+        if isinstance(enc, ApproxEncoding):
+            return round(num * enc.scale)
+        return num
+
+    def observe(self, model: str, estimated: int, actual: int):
+        """Compare a count with the usage of the API, and calibrate the estimate of model"""
+        if not estimated or not actual:
+            return
+        with self.lock:
+            samples = self.accuracy.setdefault(model, [0, 0.0])
+            samples[0] += 1
+            samples[1] += abs(estimated - actual) / actual
+            enc = self.approx.get(model)
+            if enc and self.encoders.get(model, enc) is enc:
+                enc.scale *= 1 + 0.3 * (actual / estimated - 1)
+
+    def report(self) -> list:
+        """Return rows of (model, tokenizer, samples, mean relative error, scale)"""
+        rows = []
+        with self.lock:
+            for model, (samples, errors) in self.accuracy.items():
+                enc = self.encoders.get(model) or self.approx.get(model)
+                scale = enc.scale if isinstance(enc, ApproxEncoding) else None
+                rows.append((model, enc.name if enc else "-", samples, errors / samples, scale))
+        return rows
+
+    # Reference:
+    # https://platform.openai.com/docs/guides/chat/managing-tokens
+    def count_message(self, model: str, message: dict) -> int:
+        num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        for key, value in message.items():
+            num_tokens += self.count(model, value)
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        return num_tokens
+
+    def count_messages(self, model: str, messages: list) -> int:
+        num_tokens = sum(self.count_message(model, m) for m in messages)
+        num_tokens += 2  # every reply is primed with <im_start>assistant
+        return num_tokens
+
+
+class HistoryCompactor:
+    """
+    Rolling summary of the oldest turns of a session, messages before `upto`
+    are sent as one system message with the summary. Compaction runs on a
+    background thread and extends the previous summary, summaries are cached
+    by a digest chained over the summarized messages, so a reloaded session
+    reuses them.
+    """
+    def __init__(self, summarize, size=64):
+        self.summarize = summarize # (previous summary, messages) -> summary
+        self.size = size
+        self.cache = OrderedDict()
+        self.state = (0, b"", "", None) # upto, digest, summary, last summarized message
+        self.lock = threading.Lock()
+        self.pool = None
+        self.future = None
+        self.error = None
+
+    @staticmethod
+    def chain(digest: bytes, messages: list) -> bytes:
+        h = hashlib.blake2b(digest, digest_size=16)
+        for m in messages:
+            h.update(json.dumps(m, ensure_ascii=False, sort_keys=True).encode() + b"\0")
+        return h.digest()
+
+    @property
+    def busy(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def current(self, session) -> tuple:
+        """Return (upto, summary) if the summary still matches the start of session"""
+        upto, _, summary, last = self.state
+        if upto and (len(session) < upto or session[upto - 1] != last):
+            self.reset()
+            return 0, ""
+        return upto, summary
+
+    def reset(self):
+        with self.lock:
+            self.state = (0, b"", "", None)
+
+    def replay(self, session):
+        """Fast-forward through cached summaries that match the session, e.g. after a reload"""
+        while True:
+            upto, digest, _, _ = self.state
+            for key, (parent, count, summary) in list(self.cache.items()):
+                if parent != digest or upto + count > len(session):
+                    continue
+                messages = session[upto:upto + count]
+                if self.chain(digest, messages) == key:
+                    self.install((upto, digest), upto + count, key, summary, messages[-1])
+                    break
+            else:
+                return
+
+    def install(self, base: tuple, upto: int, digest: bytes, summary: str, last: dict):
+        with self.lock:
+            self.cache[digest] = (base[1], upto - base[0], summary)
+            self.cache.move_to_end(digest)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            # drop the result if the session was reset meanwhile
+            if self.state[:2] == base:
+                self.state = (upto, digest, summary, last)
+
+    def submit(self, session, end: int):
+        """Summarize session[upto:end] into the current summary"""
+        upto, digest, summary, _ = self.state
+        base = (upto, digest)
+        messages = session[upto:end]
+        key = self.chain(digest, messages)
+        if key in self.cache:
+            self.install(base, end, key, self.cache[key][2], messages[-1])
+            return
+        def job():
+            try:
+                self.install(base, end, key, self.summarize(summary, messages), messages[-1])
+            except Exception as e:
+                self.error = e
+        if self.pool is None:
+            self.pool = futures.ThreadPoolExecutor(1, thread_name_prefix="compact")
+        self.future = self.pool.submit(job)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+
+class ResponseCache:
+    """
+    SQLite cache of answers, keyed by the hash of model, messages and sampling
+    parameters, entries expire after ttl seconds and the least recently used
+    ones are evicted above size entries.
+    """
+    def __init__(self, file, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, model TEXT, "
+                        "content TEXT, created REAL, accessed REAL)")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: list, **params) -> str:
+        data = json.dumps([model, messages, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT content FROM cache WHERE key = ? AND created > ?",
+                                  (key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+        return row[0]
+
+    def put(self, key: str, model: str, content: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                            (key, model, content, now, now))
+            self.db.execute("DELETE FROM cache WHERE created <= ?", (now - self.ttl,))
+            self.db.execute("DELETE FROM cache WHERE key NOT IN "
+                            "(SELECT key FROM cache ORDER BY accessed DESC LIMIT ?)", (self.size,))
+            self.db.commit()
+
+    def purge(self):
+        with self.lock:
+            self.db.execute("DELETE FROM cache")
+            self.db.commit()
+            self.db.execute("VACUUM")
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM cache").fetchone()
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / total:.1%}" if total else "-",
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class UsageLedger:
+    """
+    SQLite ledger of completed requests shared by all gptcli processes. The
+    per-day and per-model rollup is updated in the same transaction as each
+    insert, so reports only read the small rollup table.
+    """
+    def __init__(self, file):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS requests (time REAL, model TEXT, "
+                        "prompt_tokens INTEGER, completion_tokens INTEGER, latency REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS daily (day TEXT, model TEXT, requests INTEGER, "
+                        "prompt_tokens INTEGER, completion_tokens INTEGER, latency REAL, "
+                        "PRIMARY KEY (day, model))")
+        self.db.commit()
+
+    def add(self, model: str, prompt_tokens: int, completion_tokens: int, latency: float, now=None):
+        now = now or time.time()
+        day = datetime.date.fromtimestamp(now).isoformat()
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO requests VALUES (?, ?, ?, ?, ?)",
+                            (now, model, prompt_tokens, completion_tokens, latency))
+            self.db.execute("INSERT INTO daily VALUES (?, ?, 1, ?, ?, ?) ON CONFLICT (day, model) DO UPDATE SET "
+                            "requests = requests + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                            "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                            "latency = latency + excluded.latency",
+                            (day, model, prompt_tokens, completion_tokens, latency))
+
+    def daily(self, days: int) -> list:
+        """Return rows of (day, model, requests, prompt tokens, completion tokens, latency sum) of last n days"""
+        start = (datetime.date.today() - datetime.timedelta(days - 1)).isoformat()
+        with self.lock:
+            return self.db.execute("SELECT * FROM daily WHERE day >= ? ORDER BY day, model", (start,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SessionJournal(MutableSequence):
+    """
+    Session messages backed by an append-only jsonl journal. Each message is
+    written as it's appended, and the byte offset of every line is kept in the
+    `<file>.idx` index, so a long session is reopened without parsing it and
+    older messages are only read from disk when they are accessed.
+    """
+    def __init__(self, file, cache_size=1024):
+        self.file = file
+        self.index_file = file + ".idx"
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # index -> message
+        self.offsets = array.array("Q")
+        self.fout = open(file, "ab")
+        self.fin = open(file, "rb")
+        self.size = self.load_index()
+        self.fidx = open(self.index_file, "ab")
+
+    def load_index(self) -> int:
+        size = os.path.getsize(self.file)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "rb") as f:
+                data = f.read()
+            self.offsets.frombytes(data[:len(data) - len(data) % 8])
+            if self.offsets:
+                self.fin.seek(self.offsets[-1])
+                line = self.fin.readline()
+                if line.endswith(b"\n") and self.offsets[-1] + len(line) == size:
+                    return size
+            elif size == 0:
+                return size
+            self.offsets = array.array("Q")
+        # index is missing or stale, rebuild it and drop partially written line
+        pos = 0
+        self.fin.seek(0)
+        for line in self.fin:
+            if not line.endswith(b"\n"):
+                self.fout.truncate(pos)
+                break
+            self.offsets.append(pos)
+            pos += len(line)
+        with open(self.index_file, "wb") as f:
+            self.offsets.tofile(f)
+        return pos
+
+    def read(self, index: int) -> dict:
+        message = self.cache.get(index)
+        if message is None:
+            self.fin.seek(self.offsets[index])
+            message = json.loads(self.fin.readline())
+            self.remember(index, message)
+        else:
+            self.cache.move_to_end(index)
+        return message
+
+    def remember(self, index: int, message: dict):
+        self.cache[index] = message
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.read(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("journal index out of range")
+        return self.read(index)
+
+    def __setitem__(self, index, message):
+        raise TypeError("journal is append-only")
+
+    def insert(self, index, message):
+        if index != len(self):
+            raise TypeError("journal is append-only")
+        line = json.dumps(message, ensure_ascii=False).encode() + b"\n"
+        self.fout.write(line)
+        self.fout.flush()
+        self.fidx.write(array.array("Q", [self.size]).tobytes())
+        self.fidx.flush()
+        self.offsets.append(self.size)
+        self.size += len(line)
+        self.remember(len(self) - 1, message)
+
+    def __delitem__(self, index):
+        """only the last message can be removed, e.g. a question without answer"""
+        if index not in (-1, len(self) - 1):
+            raise TypeError("journal is append-only")
+        self.truncate(len(self) - 1)
+
+    def clear(self):
+        self.truncate(0)
+
+    def truncate(self, count: int):
+        self.size = self.offsets[count] if count < len(self) else self.size
+        del self.offsets[count:]
+        for i in [i for i in self.cache if i >= count]:
+            del self.cache[i]
+        self.fout.truncate(self.size)
+        self.fidx.truncate(count * 8)
+
+    def sync(self):
+        for f in (self.fout, self.fidx):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.sync()
+        for f in (self.fout, self.fin, self.fidx):
+            f.close()
+
+
+class SessionStore(MutableSequence):
+    """
+    In-memory session with each message body stored once, keyed by content
+    hash. Messages are kept as compact records (role id, body digest, token
+    count, model id of the count), and the least recently used bodies move to
+    a temporary file once the bodies in memory pass `memory` bytes (utf-8).
+    The file is rewritten when dropped bodies take more space than live ones.
+    """
+    def __init__(self, messages=(), memory=64 * 1024 * 1024):
+        self.memory = memory
+        self.names = []      # interned roles and models
+        self.ids = {}
+        self.records = []    # (role id, digest, tokens, model id)
+        self.refs = {}       # digest -> number of records
+        self.hot = OrderedDict()  # digest -> (body, size in utf-8 bytes)
+        self.hot_size = 0
+        self.spilled = {}    # digest -> (offset, length)
+        self.spill = None
+        self.live = 0        # bytes of spilled bodies still referenced
+        self.dead = 0        # bytes of dropped bodies left in the spill file
+        self.lock = threading.Lock()
+        self.extend(messages)
+
+    def intern(self, name: str) -> int:
+        num = self.ids.get(name)
+        if num is None:
+            num = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return num
+
+    def body(self, digest: bytes) -> str:
+        with self.lock:
+            hot = self.hot.get(digest)
+            if hot is not None:
+                self.hot.move_to_end(digest)
+                return hot[0]
+            offset, length = self.spilled[digest]
+            self.spill.seek(offset)
+            text = self.spill.read(length).decode()
+            self.keep(digest, text, length)
+            return text
+
+    def keep(self, digest: bytes, text: str, size: int):
+        """Put a body of size bytes in memory and spill the coldest ones above the ceiling"""
+        self.hot[digest] = (text, size)
+        self.hot_size += size
+        while self.hot_size > self.memory and len(self.hot) > 1:
+            cold, (body, cold_size) = self.hot.popitem(last=False)
+            self.hot_size -= cold_size
+            if cold not in self.spilled:
+                if self.spill is None:
+                    import tempfile
+                    self.spill = tempfile.TemporaryFile(prefix="gptcli-session-")
+                data = body.encode()
+                self.spill.seek(0, os.SEEK_END)
+                self.spilled[cold] = (self.spill.tell(), len(data))
+                self.spill.write(data)
+                self.live += len(data)
+
+    def compact(self):
+        """Rewrite the spill file with live bodies only"""
+        if not self.spilled:
+            self.spill.close()
+            self.spill = None
+        else:
+            import tempfile
+            spill = tempfile.TemporaryFile(prefix="gptcli-session-")
+            for digest, (offset, length) in self.spilled.items():
+                self.spill.seek(offset)
+                self.spilled[digest] = (spill.tell(), length)
+                spill.write(self.spill.read(length))
+            self.spill.close()
+            self.spill = spill
+        self.dead = 0
+
+    def make_record(self, message: dict) -> tuple:
+        if message.keys() == {"role", "content"} and isinstance(message["content"], str):
+            role, text = self.intern(message["role"]), message["content"]
+        else: # e.g. named or multimodal message, kept as json
+            role, text = -1, json.dumps(message, ensure_ascii=False)
+        data = text.encode()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with self.lock:
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            if digest not in self.hot and digest not in self.spilled:
+                self.keep(digest, text, len(data))
+        return (role, digest, None, None)
+
+    def drop_record(self, record: tuple):
+        digest = record[1]
+        with self.lock:
+            self.refs[digest] -= 1
+            if self.refs[digest]:
+                return
+            del self.refs[digest]
+            hot = self.hot.pop(digest, None)
+            if hot is not None:
+                self.hot_size -= hot[1]
+            spilled = self.spilled.pop(digest, None)
+            if spilled is not None:
+                self.live -= spilled[1]
+                self.dead += spilled[1]
+                if self.dead > self.live:
+                    self.compact()
+
+    def message(self, record: tuple) -> dict:
+        if record[0] < 0:
+            return json.loads(self.body(record[1]))
+        return {"role": self.names[record[0]], "content": self.body(record[1])}
+
+    def tokens(self, index: int, model: str, count) -> int:
+        """Token count of a message for model, count(message) is only called once per model"""
+        role, digest, tokens, model_id = self.records[index]
+        if model_id is None or self.names[model_id] != model:
+            tokens = count(self[index])
+            self.records[index] = (role, digest, tokens, self.intern(model))
+        return tokens
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.message(r) for r in self.records[index]]
+        return self.message(self.records[index])
+
+    def __setitem__(self, index, message):
+        if isinstance(index, slice):
+            records = [self.make_record(m) for m in message]
+        else:
+            records = self.make_record(message)
+        old = self.records[index]
+        self.records[index] = records
+        for record in (old if isinstance(index, slice) else [old]):
+            self.drop_record(record)
+
+    def __delitem__(self, index):
+        old = self.records[index]
+        del self.records[index]
+        for record in (old if isinstance(index, slice) else [old]):
+            self.drop_record(record)
+
+    def insert(self, index, message):
+        self.records.insert(index, self.make_record(message))
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.refs.clear()
+            self.hot.clear()
+            self.hot_size = 0
+            self.spilled.clear()
+            self.live = self.dead = 0
+            if self.spill:
+                self.spill.close()
+                self.spill = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "messages": len(self.records),
+                "bodies": len(self.refs),
+                "memory": self.hot_size,
+                "spilled": self.live,
+            }
+
+
+class SessionIndex:
+    """
+    Full-text index of saved and journaled sessions in SQLite FTS5, ranked by
+    BM25. Files are indexed again only when their mtime or size changed, and
+    a grown jsonl journal only has its new lines indexed, as long as the last
+    line indexed before is unchanged.
+    """
+    modes = {".md": "md", ".json": "json", ".jsonl": "jsonl"}
+    # CJK text has no spaces between words, every character is indexed as a word
+    cjk = "\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af"
+    cjk_re = re.compile(f"([{cjk}])")
+    cjk_space_re = re.compile(f"(?<=[{cjk}\x02\x03]) (?=[{cjk}\x02\x03])")
+
+    @classmethod
+    def segment(cls, text: str) -> str:
+        return cls.cjk_re.sub(r" \1 ", text)
+
+    def __init__(self, file):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, count INTEGER,
+                                              tail TEXT);
+            CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, path TEXT, idx INTEGER,
+                                                 role TEXT, time REAL, content TEXT);
+            CREATE INDEX IF NOT EXISTS messages_path ON messages (path);
+            CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(content, content='messages', content_rowid='id');
+            CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO fts (rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO fts (fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+        """)
+        if "tail" not in [row[1] for row in self.db.execute("PRAGMA table_info(files)")]:
+            self.db.execute("ALTER TABLE files ADD COLUMN tail TEXT")
+
+    @staticmethod
+    def read(path: str, offset=0, lines=False) -> tuple:
+        """Return (text, size read), only complete lines are read if lines is true"""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        if lines:
+            data = data[:data.rfind(b"\n") + 1]
+        for encoding in Config.encodings:
+            try:
+                return data.decode(encoding), offset + len(data)
+            except UnicodeDecodeError:
+                pass
+        return data.decode(errors="replace"), offset + len(data)
+
+    @staticmethod
+    def tail(path: str, end: int, block=65536) -> str:
+        """Digest of the last line before offset end"""
+        with open(path, "rb") as f:
+            f.seek(max(end - block, 0))
+            data = f.read(end - max(end - block, 0))
+        return hashlib.blake2b(data[data.rfind(b"\n", 0, len(data) - 1) + 1:], digest_size=16).hexdigest()
+
+    def scan(self, dirs: list) -> list:
+        paths = []
+        for root in dirs:
+            for dirpath, _, files in os.walk(os.path.expanduser(root)):
+                paths.extend(os.path.join(dirpath, f) for f in files
+                             if os.path.splitext(f)[1] in self.modes)
+        return paths
+
+    def update(self, paths=(), dirs=()) -> dict:
+        """Index new and changed files of paths, dirs and the files indexed before"""
+        stats = {"files": 0, "indexed": 0, "removed": 0}
+        with self.lock:
+            known = {row[0]: row[1:] for row in self.db.execute("SELECT * FROM files")}
+        todo = set(known) | {os.path.abspath(p) for p in paths} | {os.path.abspath(p) for p in self.scan(dirs)}
+        for path in todo:
+            try:
+                st = os.stat(path)
+            except OSError:
+                with self.lock, self.db:
+                    self.db.execute("DELETE FROM messages WHERE path = ?", (path,))
+                    self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                stats["removed"] += 1
+                continue
+            stats["files"] += 1
+            old = known.get(path)
+            if old and old[:2] == (st.st_mtime, st.st_size):
+                continue
+            mode = self.modes.get(os.path.splitext(path)[1], "md")
+            # an append-only journal only has its new lines indexed, a file
+            # rewritten by .save is indexed again
+            grown = (old and mode == "jsonl" and st.st_size > old[1]
+                     and old[3] == self.tail(path, old[1]))
+            messages = None
+            if grown:
+                data, size = self.read(path, old[1], True)
+                messages = self.parse(data, mode)
+                grown = messages is not None
+            if not grown:
+                data, size = self.read(path, 0, mode == "jsonl")
+                messages = self.parse(data, mode)
+                if messages is None:
+                    # not recorded, so it is parsed again on the next update
+                    continue
+            start = old[2] if grown else 0
+            rows = [(path, start + i, m.get("role", ""), st.st_mtime, self.segment(m["content"]))
+                    for i, m in enumerate(messages) if isinstance(m, dict) and isinstance(m.get("content"), str)]
+            with self.lock, self.db:
+                if not grown:
+                    self.db.execute("DELETE FROM messages WHERE path = ?", (path,))
+                self.db.executemany("INSERT INTO messages (path, idx, role, time, content) "
+                                    "VALUES (?, ?, ?, ?, ?)", rows)
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                (path, st.st_mtime, size, start + len(messages), self.tail(path, size)))
+            stats["indexed"] += 1
+        return stats
+
+    @staticmethod
+    def parse(data: str, mode: str):
+        """Messages of a session file, None if it is not a session"""
+        try:
+            messages = Chat.parse_session(data, mode)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+        return messages if isinstance(messages, list) else None
+
+    def search(self, query: str, role=None, since=None, until=None, limit=10) -> list:
+        """Return rows of (path, message index, role, time, snippet) by BM25 rank"""
+        terms = " ".join('"{}"'.format(self.segment(t).replace('"', '""')) for t in query.split())
+        sql = ("SELECT m.path, m.idx, m.role, m.time, snippet(fts, 0, '\x02', '\x03', '...', 16) "
+               "FROM fts JOIN messages m ON m.id = fts.rowid WHERE fts MATCH ?")
+        params = [terms]
+        if role:
+            sql += " AND m.role = ?"
+            params.append(role)
+        if since:
+            sql += " AND m.time >= ?"
+            params.append(since)
+        if until:
+            sql += " AND m.time < ?"
+            params.append(until)
+        sql += " ORDER BY bm25(fts) LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [row[:4] + (self.cjk_space_re.sub("", row[4].replace("  ", " ")).strip(),) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class DocIndex:
+    """
+    Vector index of the text files under a directory. Embeddings are stored in
+    a memory-mapped float32 matrix, one normalized row per chunk, and files are
+    only embedded again when their mtime and content hash changed.
+    """
+    max_file_size = 2 * 1024 * 1024
+
+    def __init__(self, root, path):
+        self.root = os.path.abspath(root)
+        self.path = path
+        self.meta_file = os.path.join(path, "meta.json")
+        self.vector_file = os.path.join(path, "vectors.f32")
+        self.model = ""
+        self.dim = 0
+        self.files = {}   # relative path -> {"mtime", "hash", "rows": [start, end]}
+        self.chunks = []  # row -> [relative path, start, end] of the text
+        self.vectors = None
+        if os.path.exists(self.meta_file):
+            self.load()
+
+    def load(self):
+        import numpy as np
+        with open(self.meta_file, "r", encoding="utf8") as f:
+            meta = json.load(f)
+        self.model, self.dim = meta["model"], meta["dim"]
+        self.files, self.chunks = meta["files"], meta["chunks"]
+        self.vectors = None
+        if self.chunks:
+            self.vectors = np.memmap(self.vector_file, dtype=np.float32, mode="r",
+                                     shape=(len(self.chunks), self.dim))
+
+    def save(self):
+        with open(self.meta_file + ".tmp", "w", encoding="utf8") as f:
+            json.dump({"root": self.root, "model": self.model, "dim": self.dim,
+                       "files": self.files, "chunks": self.chunks}, f)
+        os.replace(self.meta_file + ".tmp", self.meta_file)
+
+    def read_text(self, rel: str):
+        path = os.path.join(self.root, rel)
+        with open(path, "rb") as f:
+            data = f.read(self.max_file_size + 1)
+        if len(data) > self.max_file_size or b"\0" in data[:8192]:
+            return None
+        for encoding in Config.encodings:
+            try:
+                return data.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+        return None
+
+    @staticmethod
+    def split(text: str, size: int) -> list:
+        """Split text at line boundaries into (start, end) chunks of at most size chars"""
+        chunks, start, pos = [], 0, 0
+        for line in text.splitlines(keepends=True):
+            while pos + len(line) - start > size:
+                end = pos if pos > start else start + size
+                chunks.append((start, end))
+                start = end
+            pos += len(line)
+        if pos > start and text[start:pos].strip():
+            chunks.append((start, pos))
+        return chunks
+
+    def scan(self) -> dict:
+        """Return {relative path: mtime} of files under root, hidden ones are skipped"""
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if name.startswith("."):
+                    continue
+                path = os.path.join(dirpath, name)
+                found[os.path.relpath(path, self.root)] = os.path.getmtime(path)
+        return found
+
+    def update(self, embed, model: str, chunk_size: int, batch: int, progress=None) -> dict:
+        """
+        Embed new and changed files with embed(texts) -> vectors, in batches,
+        and rewrite the vector matrix with rows of unchanged files kept.
+        """
+        import numpy as np
+        reembed = model != self.model
+        files, changed = {}, []
+        for rel, mtime in self.scan().items():
+            old = self.files.get(rel)
+            if old and not reembed and old["mtime"] == mtime:
+                files[rel] = old
+                continue
+            text = self.read_text(rel)
+            if text is None:
+                continue
+            digest = hashlib.sha1(text.encode()).hexdigest()
+            if old and not reembed and old["hash"] == digest:
+                files[rel] = dict(old, mtime=mtime)
+                continue
+            files[rel] = {"mtime": mtime, "hash": digest}
+            changed.append((rel, text))
+        removed = [rel for rel in self.files if rel not in files]
+        stats = {"files": len(files), "changed": len(changed), "removed": len(removed), "embedded": 0}
+        if not changed and not removed:
+            return stats
+
+        pieces = []  # (rel, start, end, text)
+        for rel, text in changed:
+            pieces.extend((rel, start, end, text[start:end]) for start, end in self.split(text, chunk_size))
+        vectors = []
+        for i in range(0, len(pieces), batch):
+            vectors.extend(embed([p[3] for p in pieces[i:i + batch]]))
+            if progress:
+                progress(min(i + batch, len(pieces)), len(pieces))
+        if pieces:
+            new = np.asarray(vectors, dtype=np.float32).reshape(len(pieces), -1)
+            new /= np.maximum(np.linalg.norm(new, axis=1, keepdims=True), 1e-12)
+        else:
+            # only deletions, or changed files without any text
+            new = np.empty((0, self.dim), np.float32)
+        dim = new.shape[1]
+
+        kept = [rel for rel in files if "rows" in files[rel]]
+        total = sum(f["rows"][1] - f["rows"][0] for f in map(files.get, kept)) + len(pieces)
+        rows = [files[rel]["rows"] for rel in kept]  # in the old matrix
+        chunks = []
+        for rel in kept:
+            start, end = files[rel]["rows"]
+            files[rel]["rows"] = [len(chunks), len(chunks) + end - start]
+            chunks.extend(self.chunks[start:end])
+        for rel, start, end, _ in pieces:
+            files[rel].setdefault("rows", [len(chunks), len(chunks)])[1] += 1
+            chunks.append([rel, start, end])
+        if total:
+            tmp = self.vector_file + ".tmp"
+            matrix = np.memmap(tmp, dtype=np.float32, mode="w+", shape=(total, dim))
+            row = 0
+            for start, end in rows:
+                matrix[row:row + end - start] = self.vectors[start:end]
+                row += end - start
+            matrix[row:] = new
+            matrix.flush()
+            del matrix
+            self.vectors = None
+            os.replace(tmp, self.vector_file)
+        else:
+            self.vectors = None
+            if os.path.exists(self.vector_file):
+                os.remove(self.vector_file)
+        self.model, self.dim, self.files, self.chunks = model, dim, files, chunks
+        self.save()
+        self.load()
+        stats["embedded"] = len(pieces)
+        return stats
+
+    def search(self, vector, k=5) -> list:
+        """Return [(score, relative path, text)] of the top k chunks by cosine similarity"""
+        import numpy as np
+        if self.vectors is None:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        scores = self.vectors @ (q / max(np.linalg.norm(q), 1e-12))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        results = []
+        for row in top[np.argsort(-scores[top])]:
+            rel, start, end = self.chunks[row]
+            text = self.read_text(rel) or ""
+            results.append((float(scores[row]), rel, text[start:end]))
+        return results
+
+
+class Endpoint:
+    """
+    API endpoint with its own key and proxy. Moving averages of time to first
+    token and error rate are tracked to pick the fastest healthy endpoint.
+    """
+    alpha = 0.3
+
+    def __init__(self, name, base_url, api_key, proxy=""):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.proxy = proxy
+        self.client = None
+        self.http = None    # httpx.Client under client, kept to warm up its pool
+        self.ttft = None    # moving average in seconds
+        self.errors = 0.0   # moving average of error rate
+        self.samples = deque(maxlen=100)
+        self.down_until = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, ttft=None, cooldown=0, ok=False):
+        """
+        Record a success with its time to first token, a success without one
+        (non-stream requests) if ok, or an error
+        """
+        with self.lock:
+            error = ttft is None and not ok
+            self.errors += self.alpha * (error - self.errors)
+            if error:
+                self.down_until = time.monotonic() + cooldown
+                return
+            if ttft is None:
+                return
+            self.samples.append(ttft)
+            self.ttft = ttft if self.ttft is None else self.ttft + self.alpha * (ttft - self.ttft)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def score(self) -> float:
+        """Expected time to first token, endpoints never used are tried first"""
+        return (self.ttft or 0.0) / max(1 - self.errors, 0.05)
+
+    def deadline(self, percentile: float, min_samples=5):
+        """Percentile of time to first token, None if not enough samples"""
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            values = sorted(self.samples)
+        return values[min(len(values) - 1, int(len(values) * percentile))]
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+            self.http = None
+
+
+class RequestTimer:
+    """
+    Time a request: setup until the response starts (stream mode only), time
+    to first token, gaps between chunks, and time spent waiting on network vs
+    rendering.
+    """
+    def __init__(self, model: str, stream: bool):
+        self.model = model
+        self.stream = stream
+        self.start = self.mark = self.last = time.perf_counter()
+        self.setup = self.ttft = self.end = None
+        self.gaps = []
+        self.wait = 0.0
+        self.render = 0.0
+
+    def connected(self, at=None):
+        """Mark when the response started, only the first call counts when requests are raced"""
+        if self.setup is not None:
+            return
+        self.mark = at or time.perf_counter()
+        self.setup = self.mark - self.start
+
+    def received(self, content=True):
+        now = time.perf_counter()
+        self.wait += now - self.mark
+        self.mark = now
+        if not content:
+            return
+        if self.ttft is None:
+            self.ttft = now - self.start
+        else:
+            self.gaps.append(now - self.last)
+        self.last = now
+
+    def rendered(self, start=None):
+        """Add render time since the last mark, or since start if rendering runs apart from reading"""
+        now = time.perf_counter()
+        if start is not None:
+            self.render += now - start
+            return
+        self.render += now - self.mark
+        self.mark = now
+
+    def ended(self):
+        self.end = time.perf_counter()
+
+    def finish(self, tokens: int) -> dict:
+        total = (self.end or time.perf_counter()) - self.start
+        generation = total - (self.ttft or 0)
+        return {
+            "time": time.time(),
+            "model": self.model,
+            "stream": self.stream,
+            "setup": self.setup,
+            "ttft": self.ttft,
+            "total": total,
+            "chunks": len(self.gaps) + (self.ttft is not None),
+            "gap_mean": sum(self.gaps) / len(self.gaps) if self.gaps else None,
+            "gap_max": max(self.gaps) if self.gaps else None,
+            "wait": self.wait,
+            "render": self.render,
+            "tokens": tokens,
+            "tps": tokens / generation if self.stream and generation > 0 else None,
+        }
+
+
+class Metrics:
+    """Rolling window of request timings per model, optionally logged to a jsonl file"""
+    fields = ("setup", "ttft", "total", "gap_mean", "gap_max", "wait", "render", "tps")
+
+    def __init__(self, window=200, file=""):
+        self.window = window
+        self.file = file
+        self.models = {}  # model -> {field: deque}
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self.lock:
+            self.last = record
+            hist = self.models.get(record["model"])
+            if hist is None:
+                hist = {f: deque(maxlen=self.window) for f in self.fields}
+                self.models[record["model"]] = hist
+            for f in self.fields:
+                if record.get(f) is not None:
+                    hist[f].append(record[f])
+            if self.file:
+                with open(self.file, "a", encoding="utf8") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    @staticmethod
+    def percentile(values: list, p: float):
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def summary(self) -> list:
+        """Return rows of (model, field, count, mean, p50, p90, max)"""
+        rows = []
+        with self.lock:
+            for model, hist in self.models.items():
+                for f in self.fields:
+                    values = sorted(hist[f])
+                    if not values:
+                        continue
+                    rows.append((model, f, len(values), sum(values) / len(values),
+                                 self.percentile(values, 0.5), self.percentile(values, 0.9), values[-1]))
+        return rows
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+class TokenBucket:
+    """Budget of requests or tokens, refilled linearly up to its limit"""
+    __slots__ = ("limit", "level", "rate", "stamp")
+
+    def __init__(self, limit: float, remaining: float, reset: float):
+        self.limit = limit
+        self.level = remaining
+        # the budget is full again after reset, a full bucket refills in a minute
+        self.rate = (limit - remaining) / reset if reset > 0 and remaining < limit else limit / 60
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.limit, self.level + self.rate * (now - self.stamp))
+        self.stamp = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount is available, never more than the whole bucket is waited for"""
+        amount = min(amount, self.limit)
+        return 0.0 if self.level >= amount else (amount - self.level) / max(self.rate, 1e-6)
+
+
+class RateLimiter:
+    """
+    Request and token budgets per host and model, learnt from the
+    x-ratelimit-* and retry-after headers of the responses. Calls reserve
+    their budget before they are sent and wait while it is short, so the
+    quota is used evenly instead of running into 429 errors.
+    """
+    duration_re = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)?")
+    model_re = re.compile(rb'"model"\s*:\s*"([^"]*)"')
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "": 1}
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.buckets = {}   # (host, model) -> (requests bucket, tokens bucket)
+        self.blocked = {}   # (host, model) -> monotonic time until retry-after
+        self.lock = threading.Lock()
+
+    @classmethod
+    def duration(cls, value) -> float:
+        """Seconds of a header like `0.5`, `20ms` or `6m0s`"""
+        if not value:
+            return 0.0
+        return sum(float(n) * cls.units[unit] for n, unit in cls.duration_re.findall(value))
+
+    @classmethod
+    def retry_after(cls, headers) -> float:
+        """Seconds to wait as told by retry-after-ms or retry-after, 0 if absent"""
+        if not headers:
+            return 0.0
+        if headers.get("retry-after-ms"):
+            try:
+                return float(headers["retry-after-ms"]) / 1000
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if not value:
+            return 0.0
+        try:
+            return float(value)
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                return 0.0
+
+    def update(self, host: str, model: str, headers, status: int = 200):
+        """Reset the budgets of (host, model) to what the server reported"""
+        key = (host, model)
+        buckets = []
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            try:
+                bucket = TokenBucket(float(limit), float(remaining),
+                                     self.duration(headers.get(f"x-ratelimit-reset-{kind}")))
+            except (TypeError, ValueError):
+                bucket = None
+            buckets.append(bucket)
+        wait = self.retry_after(headers) if status == 429 or status >= 500 else 0.0
+        with self.lock:
+            if any(buckets):
+                old = self.buckets.get(key, (None, None))
+                self.buckets[key] = tuple(new or prev for new, prev in zip(buckets, old))
+            if wait:
+                self.blocked[key] = max(self.blocked.get(key, 0.0), time.monotonic() + wait)
+
+    def observe(self, response):
+        """Response hook of the http clients, requests are told apart by the model in their body"""
+        status = response.status_code
+        headers = response.headers
+        if status < 429 and "x-ratelimit-limit-requests" not in headers and "x-ratelimit-limit-tokens" not in headers:
+            return
+        try:
+            match = self.model_re.search(response.request.content)
+        except Exception:
+            # streamed request bodies can't be read again
+            return
+        model = match.group(1).decode() if match else ""
+        self.update(response.request.url.host, model, headers, status)
+
+    def reserve(self, host: str, model: str, tokens: int) -> float:
+        """
+        Take one request and tokens from the budget of (host, model) and
+        return 0, or return the seconds to wait before trying again.
+        """
+        if not self.enabled:
+            return 0.0
+        key = (host, model)
+        with self.lock:
+            now = time.monotonic()
+            pairs = [(b, n) for b, n in zip(self.buckets.get(key, ()), (1, tokens)) if b]
+            for bucket, _ in pairs:
+                bucket.refill(now)
+            wait = max([self.blocked.get(key, 0.0) - now] + [b.delay(n) for b, n in pairs])
+            if wait > 0:
+                return wait
+            for bucket, amount in pairs:
+                bucket.level -= amount
+            return 0.0
+
+    def report(self) -> list:
+        """Rows of (host, model, requests left, tokens left) of the known budgets"""
+        rows = []
+        with self.lock:
+            now = time.monotonic()
+            for (host, model), buckets in self.buckets.items():
+                levels = []
+                for bucket in buckets:
+                    if bucket:
+                        bucket.refill(now)
+                    levels.append(f"{bucket.level:.0f}/{bucket.limit:.0f}" if bucket else "-")
+                rows.append((host, model, *levels))
+        return rows
+
+
+class Job:
+    """Chat request running in background on a snapshot of the session messages"""
+    def __init__(self, id: int, content: str, model: str, messages: list):
+        self.id = id
+        self.content = content
+        self.model = model
+        self.messages = messages
+        self.key = None
+        self.chunks = []
+        self.status = "queued"
+        self.error = ""
+        self.merged = False
+        self.cancel = threading.Event()
+        self.submitted = time.time()
+        self.finished = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.time()) - self.submitted
+
+    def finish(self, status: str):
+        self.status = status
+        self.finished = time.time()
+
+
+class StreamRender:
+    """
+    Incremental renderer for stream mode. Closed blocks (paragraphs, fenced
+    code, list items...) are printed once, only the open tail block is parsed
+    and rendered again on every update.
+    """
+    fence_re = re.compile(r"^( *)(`{3,}|~{3,})")
+    item_re = re.compile(r"^ {0,3}(?:[-+*]|\d{1,9}[.)])(?: +|$)")
+    spaced = ("bullet_list_open", "ordered_list_open", "table_open", "blockquote_open")
+
+    def __init__(self, live: "Live", markdown=True):
+        self.live = live
+        self.markdown = markdown
+        self.chunks = []    # all deltas of the answer
+        self.block = []     # complete lines of the open block
+        self.line = []      # deltas of the open line
+        self.fence = ""     # opening fence of the open code block
+        self.nested = False # the open code block is inside a list item
+        self.item = 0       # content column of the open list item, 0 outside lists
+        self.blank = False  # blank line seen in the open block
+        self.frozen = 0     # number of blocks printed
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def feed(self, delta: str):
+        self.chunks.append(delta)
+        *lines, rest = delta.split("\n")
+        if lines:
+            lines[0] = "".join(self.line) + lines[0]
+            self.line.clear()
+            for line in lines:
+                self.feed_line(line)
+        if rest:
+            self.line.append(rest)
+        self.refresh()
+
+    def feed_line(self, line: str):
+        if not self.markdown:
+            self.freeze([line])
+            return
+        if self.fence:
+            self.block.append(line)
+            mark = line.strip()
+            if mark.startswith(self.fence) and mark == mark[0] * len(mark):
+                self.fence = ""
+                if not self.nested:
+                    self.freeze(self.block)
+            return
+        if not line.strip():
+            if self.block:
+                self.blank = True
+                self.block.append(line)
+            return
+        fence = self.fence_re.match(line)
+        # a fence indented to the content of a list item belongs to the item
+        nested = bool(fence and self.item and len(fence.group(1)) >= self.item)
+        if fence and not nested and len(fence.group(1)) > 3:
+            fence = None
+        if self.block and ((fence and not nested) or (self.blank and not line[0].isspace())):
+            self.freeze(self.block)
+        item = self.item_re.match(line)
+        if item:
+            self.item = len(item.group(0))
+        self.block.append(line)
+        if fence:
+            self.fence = fence.group(2)
+            self.nested = nested
+
+    def freeze(self, lines: list):
+        text = "\n".join(lines).rstrip()
+        lines.clear()
+        self.blank = False
+        self.item = 0
+        if self.markdown:
+            self.live.console.print(self.markdown_block(text))
+        else:
+            self.live.console.print(Text(text))
+        self.frozen += 1
+
+    def render(self):
+        text = "\n".join(self.block + ["".join(self.line)])
+        if not self.markdown:
+            return Text(text)
+        return self.markdown_block(text)
+
+    def markdown_block(self, text: str):
+        from rich.markdown import Markdown
+        md = Markdown(text)
+        # lists, tables and quotes already start with a new line
+        if self.frozen and md.parsed and md.parsed[0].type not in self.spaced:
+            return Group(Text(), md)
+        return md
+
+    def refresh(self):
+        self.live.update(self.render(), refresh=True)
+
+
+class Chat:
+    """
+    Chat session with the API, used by the interactive console as well as
+    the one-shot and batch mode which don't need cmd2 at all.
+    """
+    def __init__(self, config, verbose=True, stderr=False):
+        self.console = Console(stderr=stderr)
+        self._client_lock = threading.Lock()
+        self._hedge_pool = None
+        # Init config
+        if verbose:
+            self.print("Loading config from:", config)
+        self.config = Config(config)
+        if verbose:
+            self.print(self.config)
+
+        self.single_tokens_used = 0
+        self.total_tokens_used  = 0
+        if self.config.tokenizer_cache:
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", self.config.tokenizer_cache)
+        self.tokens = TokenCounter(self.config.token_cache_size, self.config.tokenizers)
+        self.limiter = RateLimiter(self.config.rate_limit)
+        self.session = self.new_session()
+        self._cache = None
+        self._ledger = None
+        self._search = None
+        self.search_results = []
+        self.cache_bypass = False
+        self.context_dropped = 0
+        self.metrics = Metrics(self.config.metrics_window, self.config.metrics_file)
+        self.endpoints = self.build_endpoints()
+        self.doc_index = None
+        self.compactor = HistoryCompactor(self.summarize)
+        self.jobs = OrderedDict()
+        self._job_pool = None
+        if self.config.journal:
+            self.open_journal(os.path.expanduser(self.config.journal))
+
+    def close(self):
+        self.cancel_jobs()
+        self.compactor.close()
+        self.close_client()
+        self.close_journal()
+
+    @property
+    def sep(self):
+        from rich.markdown import Markdown
+        return Markdown("---")
+
+    def print(self, *msg, **kwargs):
+        self.console.print(*msg, **kwargs)
+
+    def handle_input(self, content: str, context: list = None):
+        """Chat with content, context messages are sent after the prompt for this request only"""
+        if not content:
+            return
+        self.session.append({"role": "user", "content": content})
+        messages = self.messages
+        if context:
+            pos = len(self.config.prompt)
+            messages[pos:pos] = context
+        if self.context_dropped:
+            self.console.log(f"Context budget {self.config.get_budget()}: "
+                             f"dropped {self.context_dropped} earlier messages")
+        if self.config.stream:
+            answer = self.query_openai_stream(messages)
+        else:
+            answer = self.query_openai(messages)
+        if not answer:
+            self.session.pop()
+        else:
+            self.session.append({"role": "assistant", "content": answer})
+            if isinstance(self.session, SessionJournal):
+                self.session.sync()
+            self.compact()
+
+        if self.config.showtokens:
+            self.console.log(f"Tokens used: {self.single_tokens_used}")
+
+    @property
+    def messages(self):
+        msgs = []
+        msgs.extend(self.config.prompt)
+        self.context_dropped = 0
+        if self.config.context == ContextLevel.FULL and self.config.compact:
+            self.compactor.current(self.session)
+            self.compactor.replay(self.session)
+            upto, summary = self.compactor.current(self.session)
+            if summary:
+                msgs.append({"role": "system", "content": "Summary of the earlier conversation:\n" + summary})
+            msgs.extend(self.session[upto:])
+        elif self.config.context == ContextLevel.FULL:
+            msgs.extend(self.session)
+        elif self.config.context == ContextLevel.BUDGET:
+            msgs.extend(self.fit_budget(msgs))
+        elif self.config.context == ContextLevel.REQUEST:
+            msgs.extend([s for s in self.session if s["role"] != "assistant"])
+        else: # NO Context
+            msgs.append(self.session[-1])
+        return msgs
+
+    def fit_budget(self, prompt: list) -> list:
+        """
+        Keep the latest message and as many of the newest whole turns as fit
+        into the token budget after the prompt.
+        """
+        model = self.config.model
+        # walk back by index, so only the needed messages of a journal are read
+        latest = self.session[-1]
+        budget = (self.config.get_budget() - self.tokens.count_messages(model, prompt)
+                  - self.message_tokens(len(self.session) - 1))
+        kept, turn, size = [], [], 0
+        for i in range(len(self.session) - 2, -1, -1):
+            msg = self.session[i]
+            turn.append(msg)
+            size += self.message_tokens(i)
+            if msg["role"] != "user" and i > 0:
+                continue # a turn starts with user message
+            if size > budget:
+                break
+            budget -= size
+            kept.extend(turn)
+            turn, size = [], 0
+        kept.reverse()
+        self.context_dropped = len(self.session) - 1 - len(kept)
+        kept.append(latest)
+        return kept
+
+    def compact(self):
+        """
+        Summarize the oldest turns in background once the full context passes
+        compact_threshold tokens, the newest turns within compact_keep tokens
+        are kept as is.
+        """
+        cfg = self.config
+        comp = self.compactor
+        if not cfg.compact or cfg.context != ContextLevel.FULL:
+            return
+        if comp.error:
+            self.console.log(f"History compaction failed: {comp.error}")
+            comp.error = None
+        if comp.busy:
+            return
+        comp.current(self.session)
+        comp.replay(self.session)
+        upto, summary = comp.current(self.session)
+        recent = self.session[upto:]
+        size = self.tokens.count_messages(cfg.model, cfg.prompt) + self.tokens.count(cfg.model, summary)
+        sizes = [self.message_tokens(i) for i in range(upto, len(self.session))]
+        if size + sum(sizes) <= cfg.compact_threshold:
+            return
+        # cut at the oldest turn start that keeps the newest turns within compact_keep
+        cut, kept = len(recent), 0
+        for i in range(len(recent) - 1, 0, -1):
+            kept += sizes[i]
+            if kept > cfg.compact_keep:
+                break
+            if recent[i]["role"] == "user":
+                cut = i
+        if cut == len(recent):
+            cut = max((i for i in range(1, len(recent)) if recent[i]["role"] == "user"), default=0)
+        if cut > 0:
+            comp.submit(self.session, upto + cut)
+
+    def summarize(self, summary: str, messages: list) -> str:
+        transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if summary:
+            transcript = f"Summary so far:\n{summary}\n\nNew messages:\n{transcript}"
+        request = [
+            {"role": "system", "content": "Condense the conversation into a brief summary that keeps "
+             "facts, decisions, names, code identifiers and open questions needed to continue it. "
+             "Reply with the summary only."},
+            {"role": "user", "content": transcript},
+        ]
+        model = self.config.compact_model or self.config.model
+        start = time.perf_counter()
+        response = self.create_completion(model, request)
+        if response.usage:
+            self.total_tokens_used += response.usage.total_tokens
+            self.record_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                              time.perf_counter() - start, request)
+        return response.choices[0].message.content
+
+    def message_tokens(self, index: int) -> int:
+        """Token count of a session message, kept in the record of a session store"""
+        count = partial(self.tokens.count_message, self.config.model)
+        if isinstance(self.session, SessionStore):
+            return self.session.tokens(index, self.config.model, count)
+        return count(self.session[index])
+
+    def new_session(self, messages=()) -> SessionStore:
+        return SessionStore(messages, self.config.session_memory * 1024 * 1024)
+
+    def reset_session(self):
+        """Clear session, a journal is detached instead of being truncated"""
+        self.compactor.reset()
+        if isinstance(self.session, SessionJournal):
+            self.session.close()
+            self.session = self.new_session()
+        else:
+            self.session.clear()
+
+    def open_journal(self, file):
+        journal = SessionJournal(file, self.config.journal_cache)
+        if len(journal):
+            self.print("Reopen journal {} with {} records".format(file, len(journal)))
+        else:
+            journal.extend(self.session)
+            journal.sync()
+            self.print("Start journal {} with {} records".format(file, len(journal)))
+        self.close_journal()
+        self.session = journal
+
+    def close_journal(self):
+        if isinstance(self.session, SessionJournal):
+            self.session.close()
+            self.session = self.new_session()
+
+    def embed(self, texts: list) -> list:
+        model = self.config.embedding_model
+        tokens = sum(self.tokens.count(model, text) for text in texts)
+
+        def create():
+            client = self.get_client()
+            self.acquire(client.base_url.host, model, tokens)
+            return client.embeddings.create(model=model, input=texts)
+        response = self.retry(create)
+        return [d.embedding for d in response.data]
+
+    def open_index(self, root) -> DocIndex:
+        name = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+        path = os.path.join(self.config.index_dir, name)
+        os.makedirs(path, exist_ok=True)
+        return DocIndex(root, path)
+
+    @staticmethod
+    def parse_session(data: str, mode="md") -> list:
+        if mode == "json":
+            return json.loads(data)
+        if mode == "jsonl":
+            return [json.loads(line) for line in data.splitlines() if line]
+        messages = []
+        for chat in data.split(Config.mdSep):
+            role, content = chat.split(": ", 1)
+            messages.append({"role": role, "content": content})
+        return messages
+
+    def load_session(self, file, mode="md", encoding=None, append=False):
+        if not append:
+            self.reset_session()
+        with open(file, "r", encoding=encoding) as f:
+            data = f.read()
+        self.session.extend(self.parse_session(data, mode))
+        self.print("Load {} records from {}".format(len(self.session), file))
+
+    def save_session(self, file, mode="md", encoding=None):
+        self.print("Save {} records to {}".format(len(self.session), file))
+        if mode == "json":
+            data = json.dumps(list(self.session), indent=2)
+        elif mode == "jsonl":
+            data = "".join(json.dumps(chat, ensure_ascii=False) + "\n" for chat in self.session)
+        elif mode == "md":
+            chats = ["{}: {}".format(chat["role"], chat["content"])
+                     for chat in self.session]
+            data = Config.mdSep.join(chats)
+        with open(file, "w", encoding=encoding) as f:
+            f.write(data)
+
+    def num_tokens_from_messages(self, messages):
+        """Returns the number of tokens used by a list of messages."""
+        return self.tokens.count_messages(self.config.model, messages)
+
+    def build_endpoints(self) -> list:
+        """The configured api_key/base_url/proxy first, then the fallback endpoints"""
+        cfg = self.config
+        endpoints = [Endpoint("default", cfg.base_url, cfg.api_key, cfg.proxy)]
+        for i, ep in enumerate(cfg.endpoints, 1):
+            endpoints.append(Endpoint(
+                ep.get("name", f"endpoint{i}"),
+                ep.get("base_url", cfg.base_url),
+                ep.get("api_key", cfg.api_key),
+                ep.get("proxy", cfg.proxy),
+            ))
+        return endpoints
+
+    def pick_endpoints(self) -> list:
+        """Endpoints ordered by health and expected time to first token"""
+        return sorted(self.endpoints, key=lambda ep: (not ep.healthy, ep.score()))
+
+    def get_client(self, endpoint: Endpoint = None) -> "openai.OpenAI":
+        """
+        Return the shared client of endpoint (the best one by default), the
+        underlying connection pool is kept alive across chats and only rebuilt
+        when api_key/base_url/proxy changes.
+        """
+        endpoint = endpoint or self.pick_endpoints()[0]
+        with self._client_lock:
+            if endpoint.client is None:
+                endpoint.client = self.build_client(endpoint)
+            return endpoint.client
+
+    def build_client(self, endpoint: Endpoint) -> "openai.OpenAI":
+        import httpx
+        import openai
+        endpoint.http = self.build_http_client(httpx.Client, endpoint.proxy)
+        return openai.OpenAI(
+            api_key=endpoint.api_key,
+            base_url=endpoint.base_url,
+            http_client=endpoint.http,
+            # retried by the scheduler, which knows the rate limits and other endpoints
+            max_retries=0,
+            )
+
+    def build_http_client(self, cls, proxy: str):
+        import httpx
+        cfg = self.config
+        kwargs = dict(
+            limits=httpx.Limits(
+                max_connections=cfg.max_connections,
+                max_keepalive_connections=cfg.max_keepalive,
+                keepalive_expiry=cfg.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(cfg.timeout, connect=cfg.connect_timeout),
+            http2=cfg.http2,
+            event_hooks={"response": [self.limiter.observe]},
+        )
+        if issubclass(cls, httpx.AsyncClient):
+            async def observe(response):
+                self.limiter.observe(response)
+            kwargs["event_hooks"] = {"response": [observe]}
+        if proxy:
+            kwargs["proxy"] = proxy
+        try:
+            return cls(**kwargs)
+        except ImportError as e:
+            # http2 needs the optional `h2` package
+            self.print("Disable http2:", e)
+            kwargs["http2"] = False
+            return cls(**kwargs)
+
+    def reset_client(self, *args):
+        with self._client_lock:
+            endpoints, self.endpoints = self.endpoints, self.build_endpoints()
+        for endpoint in endpoints:
+            endpoint.close()
+
+    @staticmethod
+    def transient_errors() -> tuple:
+        """Errors worth a retry or a failover to another endpoint"""
+        import openai
+        return (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+    def pause(self, seconds: float, reason: str, on_wait=None):
+        """Sleep before a request, on_wait(seconds left, reason) is called every half second"""
+        if on_wait is None:
+            if seconds >= 1:
+                self.console.log(f"{reason}, waiting {seconds:.1f}s")
+            time.sleep(seconds)
+            return
+        end = time.monotonic() + seconds
+        left = seconds
+        while left > 0:
+            on_wait(left, reason)
+            time.sleep(min(left, 0.5))
+            left = end - time.monotonic()
+        on_wait(0, reason)
+
+    def acquire(self, host: str, model: str, tokens: int, on_wait=None):
+        """Wait until the rate limit budget of host and model has room for a request of tokens"""
+        if not self.limiter.enabled:
+            return
+        while True:
+            wait = self.limiter.reserve(host, model, tokens)
+            if wait <= 0:
+                return
+            self.pause(wait, "Rate limited", on_wait)
+
+    async def acquire_async(self, host: str, model: str, messages: list):
+        import asyncio
+        if not self.limiter.enabled:
+            return
+        tokens = await asyncio.get_running_loop().run_in_executor(None, self.tokens.count_messages, model, messages)
+        while True:
+            wait = self.limiter.reserve(host, model, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def retry(self, call, retries=None, on_wait=None, stats=None):
+        """
+        Return call(), and call it again on 429, 5xx and connection errors
+        after a jittered exponential backoff, or the retry-after of the server
+        if that is longer. The number of calls is kept in stats["attempts"].
+        """
+        retries = self.config.retries if retries is None else retries
+        for attempt in itertools.count():
+            if stats is not None:
+                stats["attempts"] = attempt + 1
+            try:
+                return call()
+            except self.transient_errors() as e:
+                if attempt >= retries:
+                    raise
+                self.pause(self.backoff(attempt, e), f"{type(e).__name__}, retry {attempt + 1}/{retries}", on_wait)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Jittered exponential delay before a retry, or the retry-after of the server if longer"""
+        wait = self.config.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        response = getattr(error, "response", None)
+        if response is not None:
+            wait = max(wait, RateLimiter.retry_after(response.headers))
+        return wait
+
+    def create_completion(self, model: str, messages: list, retries=None, on_wait=None, stats=None):
+        """Non-stream request, retried with backoff when all endpoints failed"""
+        return self.retry(lambda: self.failover_completion(model, messages, on_wait), retries, on_wait, stats)
+
+    def failover_completion(self, model: str, messages: list, on_wait=None):
+        """Non-stream request to the best endpoint, fail over to others on transient errors"""
+        endpoints = self.pick_endpoints()
+        for i, endpoint in enumerate(endpoints):
+            client = self.get_client(endpoint)
+            self.acquire(client.base_url.host, model, self.tokens.count_messages(model, messages), on_wait)
+            try:
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=messages
+                )
+            except self.transient_errors() as e:
+                endpoint.record(cooldown=self.config.failover_cooldown)
+                if i == len(endpoints) - 1:
+                    raise
+                self.console.log(f"Endpoint {endpoint.name} failed, fail over: {e}")
+                continue
+            # full latency of a whole answer would skew the first token times of streams
+            endpoint.record(ok=True)
+            return response
+
+    def first_token(self, endpoint: Endpoint, model: str, messages: list, on_wait=None, timer=None) -> tuple:
+        """
+        Start a stream and read it until the first token, return (endpoint,
+        chunks read, stream). The timer is marked connected when the response
+        started, not when the first token arrived.
+        """
+        client = self.get_client(endpoint)
+        self.acquire(client.base_url.host, model, self.tokens.count_messages(model, messages), on_wait)
+        start = time.perf_counter()
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+        )
+        connected = time.perf_counter()
+        head = []
+        try:
+            for chunk in stream:
+                head.append(chunk)
+                if chunk.choices and (chunk.choices[0].delta.content or chunk.choices[0].finish_reason):
+                    break
+        except BaseException:
+            stream.close()
+            raise
+        endpoint.record(time.perf_counter() - start)
+        if timer:
+            timer.connected(connected)
+        return endpoint, head, stream
+
+    @staticmethod
+    def close_stream(future: futures.Future):
+        if not future.cancelled() and future.exception() is None:
+            future.result()[2].close()
+
+    def open_stream(self, model: str, messages: list, retries=None, on_wait=None, timer=None) -> tuple:
+        """Start a stream, retried with backoff when all endpoints failed"""
+        return self.retry(lambda: self.failover_stream(model, messages, on_wait, timer), retries, on_wait)
+
+    def failover_stream(self, model: str, messages: list, on_wait=None, timer=None) -> tuple:
+        """
+        Start a stream on the best endpoint and fail over to the next one on
+        transient errors. With hedge enabled, when no token arrives before the
+        percentile deadline of the endpoint, a second request is raced on the
+        next endpoint and the loser is closed.
+        """
+        endpoints = self.pick_endpoints()
+        cooldown = self.config.failover_cooldown
+        if not self.config.hedge or len(endpoints) < 2:
+            for i, endpoint in enumerate(endpoints):
+                try:
+                    return self.first_token(endpoint, model, messages, on_wait, timer)
+                except self.transient_errors() as e:
+                    endpoint.record(cooldown=cooldown)
+                    if i == len(endpoints) - 1:
+                        raise
+                    self.console.log(f"Endpoint {endpoint.name} failed, fail over: {e}")
+
+        if self._hedge_pool is None:
+            self._hedge_pool = futures.ThreadPoolExecutor(4, thread_name_prefix="hedge")
+        pending = {}
+
+        def launch():
+            endpoint = endpoints.pop(0)
+            pending[self._hedge_pool.submit(self.first_token, endpoint, model, messages, on_wait, timer)] = endpoint
+
+        launch()
+        hedged = False
+        try:
+            while pending:
+                timeout = None
+                if not hedged and endpoints:
+                    timeout = next(iter(pending.values())).deadline(self.config.hedge_percentile)
+                done, _ = futures.wait(pending, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.console.log(f"No token after {timeout:.2f}s, hedge to {endpoints[0].name}")
+                    launch()
+                    continue
+                for future in done:
+                    endpoint = pending.pop(future)
+                    try:
+                        return future.result()
+                    except self.transient_errors() as e:
+                        endpoint.record(cooldown=cooldown)
+                        error = e
+                        if endpoints and not pending:
+                            self.console.log(f"Endpoint {endpoint.name} failed, fail over: {e}")
+                            launch()
+            raise error
+        finally:
+            for future in pending:
+                future.add_done_callback(self.close_stream)
+
+    def close_client(self):
+        self.reset_client()
+        if self._hedge_pool:
+            self._hedge_pool.shutdown(wait=False)
+        if self._cache:
+            self._cache.close()
+        if self._ledger:
+            self._ledger.close()
+        if self._search:
+            self._search.close()
+
+    def get_cache(self) -> ResponseCache:
+        if self._cache is None:
+            cfg = self.config
+            self._cache = ResponseCache(cfg.cache_file, cfg.cache_ttl, cfg.cache_size)
+        return self._cache
+
+    def get_search(self) -> SessionIndex:
+        if self._search is None:
+            self._search = SessionIndex(self.config.search_file)
+        return self._search
+
+    def index_session(self, file):
+        """Add a saved, loaded or journal file to the search index"""
+        if self.config.search_file:
+            self.get_search().update([file])
+
+    def get_ledger(self) -> UsageLedger:
+        with self._client_lock:
+            if self._ledger is None:
+                self._ledger = UsageLedger(self.config.usage_file)
+        return self._ledger
+
+    def record_usage(self, model: str, prompt_tokens: int, completion_tokens: int, latency: float,
+                     messages: list = None):
+        """
+        Append a completed request to the usage ledger, disabled with an empty
+        usage_file. Pass the messages if the usage is returned by the API, to
+        check the local token count against it.
+        """
+        if messages is not None:
+            self.tokens.observe(model, self.tokens.count_messages(model, messages), prompt_tokens)
+        if self.config.usage_file:
+            self.get_ledger().add(model, prompt_tokens, completion_tokens, latency)
+
+    def cache_lookup(self, model: str, messages: list, bypass=False):
+        """Return (key, cached answer), key is None if cache is disabled"""
+        if not self.config.cache:
+            return None, None
+        cache = self.get_cache()
+        key = cache.make_key(model, messages)
+        bypass = bypass or self.cache_bypass
+        self.cache_bypass = False
+        return key, None if bypass else cache.get(key)
+
+    def warmup_client(self):
+        """Open a pooled connection in background, so the first chat skips the handshake"""
+        for endpoint in self.endpoints:
+            try:
+                client = self.get_client(endpoint)
+                endpoint.http.head(str(client.base_url))
+            except Exception:
+                pass
+
+    def query_openai(self, messages) -> str:
+        import openai
+        from rich.markdown import Markdown
+        key, cached = self.cache_lookup(self.config.model, messages)
+        if cached is not None:
+            self.print(Markdown(cached), self.sep)
+            self.single_tokens_used = 0
+            return cached
+        try:
+            timer = RequestTimer(self.config.model, stream=False)
+            response = self.create_completion(self.config.model, messages)
+            timer.received()
+            content = response.choices[0].message.content
+            self.print(Markdown(content), self.sep)
+            timer.rendered()
+            self.metrics.add(timer.finish(response.usage.completion_tokens))
+            self.record_usage(self.config.model, response.usage.prompt_tokens,
+                              response.usage.completion_tokens, self.metrics.last["total"], messages)
+            if key and content:
+                self.get_cache().put(key, self.config.model, content)
+
+            self.single_tokens_used = response.usage.total_tokens
+            self.total_tokens_used += self.single_tokens_used
+            return content
+        except openai.OpenAIError as e:
+            self.print("OpenAIError:", e)
+        return ""
+
+    def query_openai_stream(self, messages) -> str:
+        import openai
+        from rich.live import Live
+        from rich.spinner import Spinner
+        key, cached = self.cache_lookup(self.config.model, messages)
+        render = None
+        complete = False
+        timer = RequestTimer(self.config.model, stream=True)
+        try:
+            spinner = Spinner("dots", "Generating...")
+
+            def waiting(left: float, reason: str):
+                spinner.update(text=f"{reason}, waiting {left:.0f}s..." if left > 0 else "Generating...")
+
+            with Live(spinner, console=self.console, refresh_per_second=10) as lv:
+                render = StreamRender(lv, self.config.stream_render)
+                if cached is not None:
+                    render.feed(cached)
+                else:
+                    endpoint, head, stream = self.open_stream(self.config.model, messages, on_wait=waiting,
+                                                              timer=timer)
+                    self.render_stream(itertools.chain(head, stream), stream, render, timer)
+                complete = True
+
+        except KeyboardInterrupt:
+            self.print("Canceled")
+        except openai.OpenAIError as e:
+            self.print("OpenAIError:", e)
+            render = None
+        answer = render.text if render else ""
+        self.print(self.sep)
+        if cached is not None:
+            self.single_tokens_used = 0
+            return answer
+        if complete and answer:
+            completion_tokens = self.tokens.count(self.config.model, answer)
+            self.metrics.add(timer.finish(completion_tokens))
+            self.record_usage(self.config.model, self.num_tokens_from_messages(messages),
+                              completion_tokens, self.metrics.last["total"])
+            if key:
+                self.get_cache().put(key, self.config.model, answer)
+        self.single_tokens_used = self.num_tokens_from_messages(messages + [{"role": "assistant", "content": answer}])
+        self.total_tokens_used += self.single_tokens_used
+        return answer
+
+    def query_raw(self, content: str, out, events=False) -> bool:
+        """
+        Stream the answer to a binary file as it arrives, without rendering,
+        or as NDJSON events with timings. Return False on errors.
+        """
+        import openai
+        model = self.config.model
+        self.session.append({"role": "user", "content": content})
+        messages = self.messages
+        timer = RequestTimer(model, stream=True)
+
+        def emit(event: str, **data):
+            if events:
+                data = dict(event=event, t=round(time.perf_counter() - timer.start, 4), **data)
+                out.write(json.dumps(data, ensure_ascii=False).encode() + b"\n")
+            elif event == "delta":
+                out.write(data["content"].encode())
+            out.flush()
+
+        key, cached = self.cache_lookup(model, messages)
+        if cached is not None:
+            emit("delta", content=cached)
+            emit("done", cached=True)
+            return True
+        chunks = []
+        try:
+            endpoint, head, stream = self.open_stream(model, messages, timer=timer)
+            try:
+                for chunk in itertools.chain(head, stream):
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    timer.received(bool(delta))
+                    if delta:
+                        chunks.append(delta)
+                        emit("delta", content=delta)
+            finally:
+                stream.close()
+            timer.ended()
+        except openai.OpenAIError as e:
+            if events:
+                emit("error", message=str(e))
+            self.print("OpenAIError:", e)
+            return False
+        answer = "".join(chunks)
+        if not events and not answer.endswith("\n"):
+            out.write(b"\n")
+        record = timer.finish(self.tokens.count(model, answer))
+        self.metrics.add(record)
+        self.record_usage(model, self.num_tokens_from_messages(messages), record["tokens"], record["total"])
+        if key and answer:
+            self.get_cache().put(key, model, answer)
+        emit("done", model=model, endpoint=endpoint.name, ttft=record["ttft"], total=record["total"],
+             tokens=record["tokens"])
+        return True
+
+    @staticmethod
+    def read_stream(chunks, pending: deque, ready: threading.Event, timer: RequestTimer):
+        """Reader thread, drain the stream into pending at network speed, None marks the end"""
+        try:
+            for chunk in chunks:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                timer.received(bool(delta))
+                if delta:
+                    pending.append(delta)
+                    ready.set()
+        except Exception as e:
+            pending.append(e)
+        finally:
+            timer.ended()
+            pending.append(None)
+            ready.set()
+
+    def render_stream(self, chunks, stream, render: StreamRender, timer: RequestTimer):
+        """
+        Render a stream read by another thread, so slow terminals don't hold
+        back the network. All deltas received meanwhile are merged into one
+        frame, at most stream_fps frames per second.
+        """
+        pending = deque()
+        ready = threading.Event()
+        reader = threading.Thread(target=self.read_stream, args=(chunks, pending, ready, timer), daemon=True)
+        reader.start()
+        frame = 1 / self.config.stream_fps
+        try:
+            while True:
+                ready.wait(0.1)
+                ready.clear()
+                deltas = []
+                end = False
+                while pending:
+                    item = pending.popleft()
+                    if item is None:
+                        end = True
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    deltas.append(item)
+                if deltas:
+                    start = time.perf_counter()
+                    render.feed("".join(deltas))
+                    timer.rendered(start)
+                    if not end:
+                        time.sleep(max(0, frame - (time.perf_counter() - start)))
+                if end:
+                    return
+        finally:
+            if reader.is_alive():
+                # interrupted, the reader stops once the stream is closed
+                stream.close()
+
+    async def compare_one(self, client: "openai.AsyncOpenAI", model: str, messages: list, result: dict):
+        import asyncio
+        import openai
+        start = time.perf_counter()
+        try:
+            for attempt in itertools.count():
+                await self.acquire_async(client.base_url.host, model, messages)
+                try:
+                    stream = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        stream=True,
+                    )
+                    break
+                except self.transient_errors() as e:
+                    if attempt >= self.config.retries:
+                        raise
+                    await asyncio.sleep(self.backoff(attempt, e))
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if result["ttft"] is None:
+                        result["ttft"] = time.perf_counter() - start
+                    result["chunks"].append(chunk.choices[0].delta.content)
+        except openai.OpenAIError as e:
+            result["error"] = str(e)
+        finally:
+            result["total"] = time.perf_counter() - start
+
+    async def compare_models(self, models: list, messages: list, stacked=False) -> dict:
+        import httpx
+        import openai
+        import asyncio
+        from rich.live import Live
+        from rich.markdown import Markdown
+        from rich.panel import Panel
+        from rich.spinner import Spinner
+        from rich.table import Table
+        results = {m: {"chunks": [], "ttft": None, "total": None, "error": None} for m in models}
+
+        def render():
+            panels = []
+            for model, r in results.items():
+                if r["error"]:
+                    body = Text(r["error"], style="red")
+                elif r["chunks"]:
+                    body = Markdown("".join(r["chunks"]))
+                else:
+                    body = Spinner("dots", "Generating...")
+                status = "done" if r["total"] is not None else "..."
+                panels.append(Panel(body, title=model, subtitle=status))
+            if stacked:
+                return Group(*panels)
+            grid = Table.grid(expand=True, padding=(0, 1))
+            for _ in panels:
+                grid.add_column(ratio=1)
+            grid.add_row(*panels)
+            return grid
+
+        http_client = self.build_http_client(httpx.AsyncClient, self.config.proxy)
+        async with openai.AsyncOpenAI(api_key=self.config.api_key, base_url=self.config.base_url,
+                                      http_client=http_client, max_retries=0) as client:
+            with Live(console=self.console, get_renderable=render, refresh_per_second=10):
+                await asyncio.gather(*[self.compare_one(client, m, messages, results[m]) for m in models])
+        return results
+
+    def submit_job(self, content: str) -> Job:
+        """Run a chat in background on a snapshot of the current messages, None if the queue is full"""
+        if sum(not job.done for job in self.jobs.values()) >= self.config.jobs_queue:
+            return None
+        self.session.append({"role": "user", "content": content})
+        try:
+            messages = self.messages
+        finally:
+            del self.session[-1]
+        job = Job(len(self.jobs) + 1, content, self.config.model, messages)
+        job.key, cached = self.cache_lookup(job.model, messages)
+        self.jobs[job.id] = job
+        if cached is not None:
+            job.chunks.append(cached)
+            job.finish("done")
+            return job
+        if self._job_pool is None:
+            self._job_pool = futures.ThreadPoolExecutor(self.config.jobs_workers, thread_name_prefix="job")
+        self._job_pool.submit(self.run_job, job)
+        return job
+
+    @staticmethod
+    def job_waiting(job: Job, left: float, reason: str):
+        job.status = f"waiting {left:.0f}s" if left > 0 else "running"
+
+    def run_job(self, job: Job):
+        import openai
+        if job.cancel.is_set():
+            if not job.done:
+                job.finish("canceled")
+            return
+        job.status = "running"
+        timer = RequestTimer(job.model, stream=True)
+        try:
+            _, head, stream = self.open_stream(job.model, job.messages, on_wait=partial(self.job_waiting, job),
+                                               timer=timer)
+            try:
+                for chunk in itertools.chain(head, stream):
+                    if job.cancel.is_set():
+                        job.finish("canceled")
+                        return
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    timer.received(bool(delta))
+                    if delta:
+                        job.chunks.append(delta)
+            finally:
+                stream.close()
+        except openai.OpenAIError as e:
+            job.error = str(e)
+            job.finish("failed")
+            return
+        except Exception as e:
+            job.error = repr(e)
+            job.finish("failed")
+            return
+        answer = job.text
+        record = timer.finish(self.tokens.count(job.model, answer))
+        self.metrics.add(record)
+        self.record_usage(job.model, self.tokens.count_messages(job.model, job.messages),
+                          record["tokens"], record["total"])
+        if job.key and answer:
+            self.get_cache().put(job.key, job.model, answer)
+        job.finish("done")
+
+    def merge_jobs(self) -> list:
+        """
+        Append answers of finished jobs to the session in submission order,
+        a job still running holds back the ones submitted after it.
+        """
+        merged = []
+        for job in self.jobs.values():
+            if job.merged:
+                continue
+            if not job.done:
+                break
+            job.merged = True
+            merged.append(job)
+            if job.status != "done" or not job.text:
+                continue
+            self.session.append({"role": "user", "content": job.content})
+            self.session.append({"role": "assistant", "content": job.text})
+            self.total_tokens_used += self.num_tokens_from_messages(
+                job.messages + [{"role": "assistant", "content": job.text}])
+        if merged:
+            if isinstance(self.session, SessionJournal):
+                self.session.sync()
+            self.compact()
+        return merged
+
+    def cancel_jobs(self):
+        for job in self.jobs.values():
+            job.cancel.set()
+        if self._job_pool:
+            self._job_pool.shutdown(wait=False, cancel_futures=True)
+
+    def split_file(self, file: str, size: int):
+        """Yield (chunk, bytes read) of a text file, chunks of at most size tokens end at a line if possible"""
+        enc = self.tokens.encoder(self.config.model)
+        lines, count, pos = [], 0, 0
+        with open(file, "r", encoding="utf8", errors="replace") as f:
+            for line in f:
+                pos += len(line.encode())
+                tokens = enc.encode(line, disallowed_special=())
+                if lines and count + len(tokens) > size:
+                    yield "".join(lines), pos
+                    lines, count = [], 0
+                while len(tokens) > size: # a huge line is split at token boundaries
+                    yield enc.decode(tokens[:size]), pos
+                    tokens = tokens[size:]
+                    line = enc.decode(tokens)
+                lines.append(line)
+                count += len(tokens)
+        if lines:
+            yield "".join(lines), pos
+
+    def ask_part(self, content: str) -> str:
+        """Single request for a part of a file, answers are cached and recorded in the ledger"""
+        model = self.config.model
+        messages = self.config.prompt + [{"role": "user", "content": content}]
+        key, cached = self.cache_lookup(model, messages)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        response = self.create_completion(model, messages)
+        answer = response.choices[0].message.content or ""
+        if response.usage:
+            self.total_tokens_used += response.usage.total_tokens
+            self.record_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                              time.perf_counter() - start, messages)
+        if key and answer:
+            self.get_cache().put(key, model, answer)
+        return answer
+
+    def map_file(self, file: str, question: str, size: int, progress=None) -> list:
+        """
+        Ask the question about every chunk of a file concurrently, with at most
+        file_concurrency requests and twice as many chunks in memory, and
+        return the answers in file order.
+        """
+        name = os.path.basename(file)
+        total = os.path.getsize(file)
+        answers = {}
+        workers = self.config.file_concurrency
+        with futures.ThreadPoolExecutor(workers, thread_name_prefix="file") as pool:
+            pending = {}
+            def collect(wait_all=False):
+                done, _ = futures.wait(pending, return_when=futures.ALL_COMPLETED if wait_all
+                                       else futures.FIRST_COMPLETED)
+                for fu in done:
+                    answers[pending.pop(fu)] = fu.result()
+            try:
+                for i, (chunk, pos) in enumerate(self.split_file(file, size), 1):
+                    content = (f"Part {i} of the file {name}:\n\n{chunk}\n\n{question}\n"
+                               "Answer from this part only and briefly, or reply 'nothing relevant'.")
+                    pending[pool.submit(self.ask_part, content)] = i
+                    if progress:
+                        progress(pos, total, len(answers), i)
+                    if len(pending) >= workers * 2:
+                        collect()
+                        if progress:
+                            progress(pos, total, len(answers), i)
+                while pending:
+                    collect()
+                    if progress:
+                        progress(total, total, len(answers), len(answers) + len(pending))
+            except BaseException:
+                for fu in pending:
+                    fu.cancel()
+                raise
+        return [answers[i] for i in sorted(answers)]
+
+    def reduce_answers(self, file: str, question: str, answers: list, size: int) -> list:
+        """Combine groups of answers until all of them fit into size tokens"""
+        model = self.config.model
+        name = os.path.basename(file)
+        while len(answers) > 1 and sum(self.tokens.count(model, a) for a in answers) > size:
+            groups, group, count = [], [], 0
+            for answer in answers:
+                n = self.tokens.count(model, answer)
+                if group and count + n > size:
+                    groups.append(group)
+                    group, count = [], 0
+                group.append(answer)
+                count += n
+            groups.append(group)
+            if len(groups) == len(answers): # every answer alone fills the budget
+                answers = [a[:size] for a in answers]
+                break
+            with futures.ThreadPoolExecutor(self.config.file_concurrency, thread_name_prefix="file") as pool:
+                answers = list(pool.map(self.ask_part, [
+                    f"Partial answers, each from a part of the file {name}:\n\n" + "\n\n---\n\n".join(g) +
+                    f"\n\nCombine them into one brief answer to: {question}" for g in groups]))
+        return answers
+
+    def batch_request(self, req: dict, prompts: dict, retries: int) -> dict:
+        """Run a single batch request, retry with backoff on transient errors"""
+        import openai
+        model = req.get("model") or self.config.model
+        prompt = self.config.prompt
+        result = {"id": req["id"], "model": model}
+        try:
+            if req.get("prompt"):
+                if req["prompt"] not in prompts:
+                    prompts[req["prompt"]] = Config.read_prompt(req["prompt"])
+                prompt = prompts[req["prompt"]]
+            messages = prompt + (req.get("messages") or [{"role": "user", "content": req.get("content", "")}])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # a bad line fails alone instead of the whole batch
+            result.update(error=f"bad request: {type(e).__name__}: {e}", attempts=0, latency=0.0)
+            return result
+        start = time.perf_counter()
+        key, cached = self.cache_lookup(model, messages, bypass=not req.get("cache", True))
+        if cached is not None:
+            result.update(content=cached, cached=True, latency=round(time.perf_counter() - start, 3))
+            return result
+        try:
+            response = self.create_completion(model, messages, retries=retries, stats=result)
+            result["content"] = response.choices[0].message.content
+            result["usage"] = response.usage.model_dump(exclude_none=True) if response.usage else None
+            if response.usage:
+                self.record_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                                  time.perf_counter() - start, messages)
+            if key and result["content"]:
+                self.get_cache().put(key, model, result["content"])
+        except openai.OpenAIError as e:
+            result["error"] = str(e)
+        result["latency"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run_batch(self, infile: str, outfile: str, concurrency=4, retries=3):
+        """
+        Run jsonl requests from infile on a thread pool and append results to
+        outfile as they finish. Requests with a result in outfile are skipped,
+        failed ones are run again.
+        """
+        finished, failed = set(), set()
+        if os.path.exists(outfile):
+            with open(outfile, "r", encoding="utf8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        (failed if "error" in record else finished).add(record["id"])
+                    except (ValueError, KeyError, TypeError):
+                        pass
+        prompts = {}
+        counts = {"ok": 0, "failed": 0, "skipped": 0}
+        fin = sys.stdin if infile == "-" else open(infile, "r", encoding="utf8")
+        with fin, open(outfile, "a", encoding="utf8") as fout, \
+                futures.ThreadPoolExecutor(concurrency) as pool:
+            pending = set()
+
+            def collect(wait_all=False):
+                nonlocal pending
+                done, pending = futures.wait(
+                    pending, return_when=futures.ALL_COMPLETED if wait_all else futures.FIRST_COMPLETED)
+                for fu in done:
+                    result = fu.result()
+                    counts["failed" if "error" in result else "ok"] += 1
+                    fout.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    fout.flush()
+
+            for lineno, line in enumerate(fin, 1):
+                if not line.strip():
+                    continue
+                try:
+                    req = json.loads(line)
+                    if not isinstance(req, dict):
+                        raise ValueError("request is not a json object")
+                except ValueError as e:
+                    if lineno in finished or lineno in failed:
+                        # reported by an earlier run already
+                        counts["skipped"] += 1
+                        continue
+                    counts["failed"] += 1
+                    fout.write(json.dumps({"id": lineno, "error": f"bad request: {e}"}) + "\n")
+                    fout.flush()
+                    continue
+                req.setdefault("id", lineno)
+                if req["id"] in finished:
+                    counts["skipped"] += 1
+                    continue
+                pending.add(pool.submit(self.batch_request, req, prompts, retries))
+                if len(pending) >= concurrency * 2:
+                    collect()
+            collect(wait_all=True)
+        self.print("Batch done: {ok} ok, {failed} failed, {skipped} skipped".format(**counts))
+
+
+class Flight:
+    """Upstream response shared by identical requests in flight, chunks are kept for late joiners"""
+    def __init__(self):
+        import asyncio
+        self.status = None
+        self.content_type = "application/json"
+        self.chunks = []
+        self.done = False
+        self.changed = asyncio.Condition()
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def iterate(self):
+        i = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: len(self.chunks) > i or self.done)
+            chunks = self.chunks[i:]
+            i += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if self.done and i == len(self.chunks):
+                return
+
+
+class Gateway:
+    """
+    OpenAI-compatible `/v1/chat/completions` server in front of the configured
+    API, for many terminals and scripts. Requests share one connection pool
+    and the answer cache, identical requests in flight are merged into one
+    upstream call, and every client (told apart by its api key, or by its
+    address) has a limit of concurrent requests.
+    """
+    def __init__(self, chat: Chat):
+        self.chat = chat
+        self.config = chat.config
+        self.client = None
+        self.url = (self.config.base_url or "https://api.openai.com/v1").rstrip("/") + "/chat/completions"
+        self.inflight = {}  # request key -> Flight
+        self.tasks = set()  # upstream tasks, referenced until done so they aren't garbage collected
+        self.limits = {}    # client -> asyncio.Semaphore
+        self.clients = {}   # client -> counters
+
+    async def serve(self, host: str, port: int):
+        import asyncio
+        import httpx
+        self.client = self.chat.build_http_client(httpx.AsyncClient, self.config.proxy)
+        server = await asyncio.start_server(self.handle, host, port)
+        self.chat.print(f"Serving {self.url} on http://{host}:{port}/v1")
+        async with server, self.client:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        import asyncio
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin1").split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                token = headers.get("authorization", "").removeprefix("Bearer ")
+                # keys are shown by /metrics, only a digest of them
+                client = hashlib.sha256(token.encode()).hexdigest()[:12] if token else peer[0]
+                if not await self.dispatch(method, path.split("?")[0], client, body, writer):
+                    break
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status: int, body: bytes, content_type="application/json"):
+        from http import HTTPStatus
+        writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def dispatch(self, method: str, path: str, client: str, body: bytes, writer) -> bool:
+        """Answer a request, return False if the connection should be closed"""
+        if method == "GET" and path == "/metrics":
+            await self.respond(writer, 200, json.dumps(self.metrics(), indent=2).encode())
+            return True
+        if method != "POST" or not path.endswith("/chat/completions"):
+            await self.respond(writer, 404, b'{"error": {"message": "not found"}}')
+            return True
+        import asyncio
+        stats = self.clients.setdefault(client, dict.fromkeys(
+            ("requests", "active", "cached", "merged", "upstream", "errors"), 0))
+        limit = self.limits.setdefault(client, asyncio.Semaphore(self.config.serve_client_limit))
+        stats["requests"] += 1
+        async with limit:
+            stats["active"] += 1
+            try:
+                return await self.chat_completion(body, stats, writer)
+            finally:
+                stats["active"] -= 1
+
+    async def chat_completion(self, body: bytes, stats: dict, writer) -> bool:
+        import asyncio
+        try:
+            req = json.loads(body)
+            model, messages = req["model"], req["messages"]
+        except (ValueError, KeyError, TypeError):
+            await self.respond(writer, 400, b'{"error": {"message": "invalid request"}}')
+            return True
+        stream = bool(req.get("stream"))
+        params = {k: v for k, v in req.items() if k not in ("model", "messages", "stream", "stream_options")}
+        key = ResponseCache.make_key(model, messages, **params)
+        if self.config.cache and params.get("n", 1) == 1:
+            cached = self.chat.get_cache().get(key)
+            if cached is not None:
+                stats["cached"] += 1
+                return await self.replay(writer, model, cached, stream)
+        flight = self.inflight.get((key, stream))
+        if flight:
+            stats["merged"] += 1
+        else:
+            stats["upstream"] += 1
+            flight = self.inflight[key, stream] = Flight()
+            task = asyncio.create_task(self.upstream(flight, body, key, model, messages, stream))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        chunks = flight.iterate()
+        if stream:
+            # wait for the status, then pass the events through as they arrive
+            first = await anext(chunks, b"")
+            if flight.status != 200:
+                stats["errors"] += 1
+                await self.respond(writer, flight.status, first + b"".join([c async for c in chunks]))
+                return True
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n" + first)
+            async for chunk in chunks:
+                writer.write(chunk)
+                await writer.drain()
+            return False
+        data = b"".join([c async for c in chunks])
+        if flight.status != 200:
+            stats["errors"] += 1
+        await self.respond(writer, flight.status, data, flight.content_type)
+        return True
+
+    async def upstream(self, flight: Flight, body: bytes, key: str, model: str, messages: list, stream: bool):
+        import asyncio
+        import httpx
+        timer = RequestTimer(model, stream)
+        headers = {"Authorization": f"Bearer {self.config.api_key}", "Content-Type": "application/json"}
+        try:
+            # pace the upstream calls, the 429s left are passed on to the clients
+            await self.chat.acquire_async(httpx.URL(self.url).host, model, messages)
+            async with self.client.stream("POST", self.url, content=body, headers=headers) as response:
+                timer.connected()
+                flight.status = response.status_code
+                flight.content_type = response.headers.get("content-type", flight.content_type)
+                async for chunk in response.aiter_raw():
+                    timer.received()
+                    flight.chunks.append(chunk)
+                    await flight.notify()
+        except httpx.HTTPError as e:
+            if flight.status is None:
+                flight.status = 502
+                flight.chunks.append(json.dumps({"error": {"message": f"upstream error: {e}"}}).encode())
+        finally:
+            if flight.status is None:
+                # failed before the request was sent, merged clients still get an answer
+                flight.status = 502
+                flight.chunks.append(json.dumps({"error": {"message": "gateway error"}}).encode())
+            flight.done = True
+            self.inflight.pop((key, stream), None)
+            await flight.notify()
+        if flight.status != 200:
+            return
+        content, usage = self.parse_answer(b"".join(flight.chunks), stream)
+        if not content:
+            return
+        if not usage:
+            tokens = self.chat.tokens
+            usage = await asyncio.get_running_loop().run_in_executor(None, lambda: {
+                "prompt_tokens": tokens.count_messages(model, messages),
+                "completion_tokens": tokens.count(model, content)})
+        record = timer.finish(usage["completion_tokens"])
+        self.chat.metrics.add(record)
+        self.chat.record_usage(model, usage["prompt_tokens"], usage["completion_tokens"], record["total"])
+        if self.config.cache:
+            self.chat.get_cache().put(key, model, content)
+
+    @staticmethod
+    def parse_answer(data: bytes, stream: bool) -> tuple:
+        """Return (content, usage or None) of a response"""
+        try:
+            if not stream:
+                response = json.loads(data)
+                return response["choices"][0]["message"]["content"], response.get("usage")
+            parts, usage = [], None
+            for line in data.decode().splitlines():
+                if not line.startswith("data:") or line[5:].strip() == "[DONE]":
+                    continue
+                event = json.loads(line[5:])
+                if event.get("choices"):
+                    parts.append(event["choices"][0]["delta"].get("content") or "")
+                if event.get("usage"):
+                    usage = event["usage"]
+            return "".join(parts), usage
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None, None
+
+    async def replay(self, writer, model: str, content: str, stream: bool) -> bool:
+        """Answer with a cached content, as a completion or as SSE events"""
+        base = {"id": "chatcmpl-cache", "created": int(time.time()), "model": model}
+        if not stream:
+            response = dict(base, object="chat.completion", choices=[{
+                "index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
+            await self.respond(writer, 200, json.dumps(response, ensure_ascii=False).encode())
+            return True
+        events = [
+            dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}]),
+            dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]),
+        ]
+        data = "".join(f"data: {json.dumps(e, ensure_ascii=False)}\n\n" for e in events) + "data: [DONE]\n\n"
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n" + data.encode())
+        await writer.drain()
+        return False
+
+    def metrics(self) -> dict:
+        fields = ("model", "field", "count", "mean", "p50", "p90", "max")
+        result = {
+            "upstream": self.url,
+            "inflight": len(self.inflight),
+            "clients": self.clients,
+            "latency": [dict(zip(fields, row)) for row in self.chat.metrics.summary()],
+        }
+        if self.config.cache:
+            result["cache"] = self.chat.get_cache().stats()
+        return result
+
+
+class GptCli(cmd2.Cmd, Chat):
     prompt = "gptcli> "
 
     def __init__(self, config):
@@ -89,35 +2931,43 @@ class GptCli(cmd2.Cmd):
         for sk in ["allow_style", "always_show_hint", "echo", "feedback_to_output",
                   "max_completion_items", "quiet", "timing"]:
             self.remove_settable(sk)
-        self.console = Console()
-        self.session = []
-        # Init config
-        self.print("Loading config from:", config)
-        self.config = Config(config)
-        self.print(self.config)
+        Chat.__init__(self, config)
         # Init settable
-        self.add_settable(Settable("api_key", str, "OPENAI_API_KEY", self.config))
-        self.add_settable(Settable("base_url", str, "OPENAI_API_BASE", self.config))
-        self.add_settable(Settable("proxy", str, "Proxy to access API", self.config))
+        self.add_settable(Settable("api_key", str, "OPENAI_API_KEY", self.config,
+                                   onchange_cb=self.reset_client))
+        self.add_settable(Settable("base_url", str, "OPENAI_API_BASE", self.config,
+                                   onchange_cb=self.reset_client))
+        self.add_settable(Settable("proxy", str, "Proxy to access API", self.config,
+                                   onchange_cb=self.reset_client))
         self.add_settable(Settable("context", lambda v: ContextLevel(int(v)), "Session context mode",
-                                   self.config, completer=partial(cmd2.Cmd.basic_complete, match_against="012")))
+                                   self.config, completer=partial(cmd2.Cmd.basic_complete, match_against="0123")))
+        self.add_settable(Settable("context_budget", int, "Max tokens of context in budget mode", self.config))
         self.add_settable(Settable("stream", bool, "Enable stream mode", self.config))
         self.add_settable(Settable("stream_render", bool, "Render live markdown in stream mode", self.config))
         self.add_settable(Settable("model", str, "LLM model to use", self.config, choices=self.config.model_choices))
         self.add_settable(Settable("showtokens", bool, "Show tokens used with the output", self.config))
+        self.add_settable(Settable("compact", bool, "Summarize old turns in full context mode", self.config))
+        self.add_settable(Settable("cache", bool, "Cache answers of identical requests on disk", self.config))
         # MISC
         with self.console.capture() as capture:
             self.print(f"[bold yellow]{self.prompt}[/]", end="")
         self.prompt = capture.get()
 
-        self.single_tokens_used = 0
-        self.total_tokens_used  = 0
+        self.register_postloop_hook(self.close)
+        if self.config.prewarm:
+            threading.Thread(target=self.warmup_client, daemon=True).start()
 
     def onecmd_plus_hooks(self, line: str, *args, **kwargs) -> bool:
         """
         Dirty hack to use Cmd2 as chat console, and avoid statement parsing
         for chat input which may result in `No closing quotation` error.
         """
+        for job in self.merge_jobs():
+            if job.status == "done":
+                self.print(f"[green]Job {job.id} done[/] in {job.elapsed:.1f}s, merged into session, "
+                           f".jobs -r {job.id} to show")
+            else:
+                self.print(f"[yellow]Job {job.id} {job.status}[/] {job.error}")
         if line.startswith("."):
             return super().onecmd_plus_hooks(line, *args, **kwargs)
         self.handle_input(line)
@@ -144,144 +2994,6 @@ class GptCli(cmd2.Cmd):
     def get_all_commands(self) -> List[str]:
         return list(map(lambda c: f".{c}", super().get_all_commands()))
 
-    def print(self, *msg, **kwargs):
-        self.console.print(*msg, **kwargs)
-
-    def handle_input(self, content: str):
-        if not content:
-            return
-        self.session.append({"role": "user", "content": content})
-        if self.config.stream:
-            answer = self.query_openai_stream(self.messages)
-        else:
-            answer = self.query_openai(self.messages)
-        if not answer:
-            self.session.pop()
-        else:
-            self.session.append({"role": "assistant", "content": answer})
-
-        if self.config.showtokens:
-            self.console.log(f"Tokens used: {self.single_tokens_used}")
-
-    @property
-    def messages(self):
-        msgs = []
-        msgs.extend(self.config.prompt)
-        if self.config.context == ContextLevel.FULL:
-            msgs.extend(self.session)
-        elif self.config.context == ContextLevel.REQUEST:
-            msgs.extend([s for s in self.session if s["role"] != "assistant"])
-        else: # NO Context
-            msgs.append(self.session[-1])
-        return msgs
-
-    def load_session(self, file, mode="md", encoding=None, append=False):
-        if not append:
-            self.session.clear()
-        with open(file, "r", encoding=encoding) as f:
-            data = f.read()
-        if mode == "json":
-            self.session.extend(json.loads(data))
-        elif mode == "md":
-            for chat in data.split(Config.mdSep):
-                role, content = chat.split(": ", 1)
-                self.session.append({"role": role, "content": content})
-        self.print("Load {} records from {}".format(len(self.session), file))
-
-    def save_session(self, file, mode="md", encoding=None):
-        self.print("Save {} records to {}".format(len(self.session), file))
-        if mode == "json":
-            data = json.dumps(self.session, indent=2)
-        elif mode == "md":
-            chats = ["{}: {}".format(chat["role"], chat["content"])
-                     for chat in self.session]
-            data = Config.mdSep.join(chats)
-        with open(file, "w", encoding=encoding) as f:
-            f.write(data)
-    
-    # Reference:
-    # https://platform.openai.com/docs/guides/chat/managing-tokens
-    def num_tokens_from_messages(self, messages):
-        """Returns the number of tokens used by a list of messages."""
-        import tiktoken
-        model = self.config.model
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
-
-    def get_client(self) -> openai.OpenAI:
-        if self.config.proxy:
-            http_client = httpx.Client(
-                proxy=self.config.proxy
-            )
-        else:
-            http_client = None
-        client = openai.OpenAI(
-            api_key=self.config.api_key,
-            base_url=self.config.base_url,
-            http_client=http_client,
-            )
-        return client
-
-    def query_openai(self, messages) -> str:
-        try:
-            client = self.get_client()
-            response = client.chat.completions.create(
-                model=self.config.model,
-                messages=messages
-            )
-            content = response.choices[0].message.content
-            self.print(Markdown(content), Config.sep)
-
-            self.single_tokens_used = response.usage.total_tokens
-            self.total_tokens_used += self.single_tokens_used
-            return content
-        except openai.OpenAIError as e:
-            self.print("OpenAIError:", e)
-        return ""
-
-    def query_openai_stream(self, messages) -> str:
-        answer = ""
-        try:
-            client = self.get_client()
-            spinner = Spinner("dots", "Generating...")
-            with Live(spinner, refresh_per_second=10) as lv:
-                res = "no result"
-                stream = client.chat.completions.create(
-                    model=self.config.model,
-                    messages=messages,
-                    stream=True,
-                )
-                for chunk in stream:
-                    finish_reason = chunk.choices[0].finish_reason
-                    if chunk.choices[0].delta.content:
-                        answer += chunk.choices[0].delta.content
-                        res = Markdown(answer) if self.config.stream_render else answer
-                        lv.update(res, refresh=True)
-                    elif finish_reason:
-                        if answer:
-                            lv.update(res, refresh=True)
-
-        except KeyboardInterrupt:
-            self.print("Canceled")
-        except openai.OpenAIError as e:
-            self.print("OpenAIError:", e)
-            answer = ""
-        self.print(Config.sep)
-        self.single_tokens_used = self.num_tokens_from_messages(messages + [{"role": "assistant", "content": answer}])
-        self.total_tokens_used += self.single_tokens_used
-        return answer
-
     parser_ml = argparse_custom.DEFAULT_ARGUMENT_PARSER()
     @with_argparser(parser_ml)
     def do_multiline(self, args):
@@ -303,7 +3015,7 @@ class GptCli(cmd2.Cmd):
     @with_argparser(parser_reset)
     def do_reset(self, args):
         "Reset session, i.e. clear chat history"
-        self.session.clear()
+        self.reset_session()
         self.print("session cleared.")
 
     parser_prompt = argparse_custom.DEFAULT_ARGUMENT_PARSER()
@@ -317,56 +3029,393 @@ class GptCli(cmd2.Cmd):
             self.config.prompt.clear()
             self.print("Prompt cleared.")
         elif args.file:
-            prompt = []
             if args.file.endswith(".json"):
                 self.print("Load prompt from json")
-                with open(args.file, "r") as f:
-                    data = json.load(f)
-                if isinstance(data, list):
-                    prompt.extend(data)
-                elif isinstance(data, dict):
-                    prompt.append(data)
             else:
                 self.print("Load prompt from text")
-                with open(args.file, "r") as f:
-                    data = f.read().rstrip()
-                prompt.append(
-                    { "role": "system", "content": data }
-                )
+            prompt = Config.read_prompt(args.file)
             self.print("Prompt loaded:", json.dumps(prompt, indent=2, ensure_ascii=False))
             self.config.prompt = prompt
         else:
             self.print("Current prompt:", json.dumps(self.config.prompt, indent=2, ensure_ascii=False))
 
     parser_save = argparse_custom.DEFAULT_ARGUMENT_PARSER()
-    parser_save.add_argument("-m", dest="mode", choices=["json", "md"],
-                             default="md", help="save as json or markdown (default: md)")
+    parser_save.add_argument("-m", dest="mode", choices=["json", "jsonl", "md"],
+                             default="md", help="save as json, jsonl or markdown (default: md)")
     parser_save.add_argument("-e", dest="encoding", choices=Config.encodings,
                              default=Config.encodings[0], help="file encoding")
     parser_save.add_argument("file", help="target file to save",
                             completer=cmd2.Cmd.path_complete)
     @with_argparser(parser_save)
     def do_save(self, args: Namespace):
-        "Save current conversation to Markdown/JSON file"
+        "Save current conversation to Markdown/JSON/JSONL file"
         self.save_session(args.file, args.mode, args.encoding)
+        self.index_session(args.file)
 
     parser_load = argparse_custom.DEFAULT_ARGUMENT_PARSER()
     parser_load.add_argument("-a", dest="append", action="store_true",
                              help="append to current chat, by default current chat will be cleared")
-    parser_load.add_argument("-m", dest="mode", choices=["json", "md"],
-                             default="md", help="load as json or markdown (default: md)")
+    parser_load.add_argument("-m", dest="mode", choices=["json", "jsonl", "md"],
+                             default="md", help="load as json, jsonl or markdown (default: md)")
     parser_load.add_argument("-e", dest="encoding", choices=Config.encodings,
                              default=Config.encodings[0], help="file encoding")
     parser_load.add_argument("file", help="target file to load",
                             completer=cmd2.Cmd.path_complete)
     @with_argparser(parser_load)
     def do_load(self, args: Namespace):
-        "Load conversation from Markdown/JSON file"
+        "Load conversation from Markdown/JSON/JSONL file"
         self.load_session(args.file, args.mode, args.encoding, args.append)
+        self.index_session(args.file)
+
+    parser_compare = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_compare.add_argument("-m", dest="models", action="append",
+                                help="model to compare, can be repeated (default: all model_choices)")
+    parser_compare.add_argument("-s", dest="stacked", action="store_true",
+                                help="stack the answers vertically instead of side by side")
+    parser_compare.add_argument("question", nargs=argparse.REMAINDER,
+                                help="question to ask, by default resend the current conversation")
+    @with_argparser(parser_compare)
+    def do_compare(self, args: Namespace):
+        "Send the conversation to several models concurrently and compare the answers"
+        import asyncio
+        from rich.table import Table
+        models = args.models or self.config.model_choices
+        if not models:
+            self.print("No models to compare, use -m or set model_choices")
+            return
+        question = " ".join(args.question)
+        if question:
+            self.session.append({"role": "user", "content": question})
+        if not self.session:
+            self.print("Nothing to ask")
+            return
+        messages = self.messages
+        start = time.perf_counter()
+        try:
+            results = asyncio.run(self.compare_models(models, messages, args.stacked))
+        except KeyboardInterrupt:
+            self.print("Canceled")
+            return
+        finally:
+            # answers are not merged into the session
+            if question:
+                self.session.pop()
+        elapsed = time.perf_counter() - start
+        table = Table("model", "TTFT(s)", "total(s)", "tokens", "tokens/s")
+        for model, r in results.items():
+            if r["error"]:
+                table.add_row(model, "-", f"{r['total']:.2f}", "-", r["error"][:40])
+                continue
+            prompt_tokens = self.tokens.count_messages(model, messages)
+            completion_tokens = self.tokens.count(model, "".join(r["chunks"]))
+            self.total_tokens_used += prompt_tokens + completion_tokens
+            self.record_usage(model, prompt_tokens, completion_tokens, r["total"])
+            ttft = f"{r['ttft']:.2f}" if r["ttft"] is not None else "-"
+            speed = completion_tokens / max(r["total"] - (r["ttft"] or 0), 1e-6)
+            table.add_row(model, ttft, f"{r['total']:.2f}", f"{prompt_tokens}+{completion_tokens}", f"{speed:.1f}")
+        self.print(table)
+        self.print(f"Wall time: {elapsed:.2f}s")
+
+    parser_cache = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_cache.add_argument("-p", dest="purge", action="store_true", help="remove all cached answers")
+    parser_cache.add_argument("-b", dest="bypass", action="store_true",
+                              help="bypass the cache for the next chat, the new answer is still cached")
+    @with_argparser(parser_cache)
+    def do_cache(self, args: Namespace):
+        "Show statistics of the answer cache, or purge it"
+        cache = self.get_cache()
+        if args.purge:
+            cache.purge()
+            self.print("Cache purged.")
+        elif args.bypass:
+            self.cache_bypass = True
+            self.print("Cache bypassed for next chat.")
+        else:
+            self.print(f"Cache: {self.config.cache_file} ({'enabled' if self.config.cache else 'disabled'})")
+            self.console.print_json(data=cache.stats())
+
+    parser_journal = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_journal.add_argument("-c", dest="close", action="store_true",
+                                help="stop journaling, the session is kept in memory")
+    parser_journal.add_argument("file", nargs="?", help="journal file to reopen or start with current chat",
+                                completer=cmd2.Cmd.path_complete)
+    @with_argparser(parser_journal)
+    def do_journal(self, args: Namespace):
+        "Record conversation in an append-only JSONL journal, or reopen one"
+        journal = self.session if isinstance(self.session, SessionJournal) else None
+        if args.close:
+            if journal:
+                self.session = self.new_session(journal)
+                journal.close()
+                self.print("Journal closed.")
+        elif args.file:
+            self.open_journal(args.file)
+            self.index_session(args.file)
+        elif journal:
+            self.print("Journal: {} ({} records)".format(journal.file, len(journal)))
+        else:
+            self.print("No journal.")
+
+    parser_stats = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_stats.add_argument("-c", dest="clear", action="store_true", help="clear collected statistics")
+    @with_argparser(parser_stats)
+    def do_stats(self, args: Namespace):
+        "Latency and throughput statistics of recent requests per model"
+        from rich.table import Table
+        if args.clear:
+            self.metrics.clear()
+            self.print("Statistics cleared.")
+            return
+        rows = self.metrics.summary()
+        if not rows:
+            self.print("No statistics yet.")
+            return
+        table = Table("model", "metric", "count", "mean", "p50", "p90", "max")
+        for model, field, count, *values in rows:
+            table.add_row(model, field, str(count), *[f"{v:.3f}" for v in values])
+        self.print(table)
+        if len(self.endpoints) > 1:
+            table = Table("endpoint", "base_url", "ttft(avg)", "error rate", "healthy")
+            for ep in self.pick_endpoints():
+                ttft = f"{ep.ttft:.3f}" if ep.ttft is not None else "-"
+                table.add_row(ep.name, str(ep.base_url), ttft, f"{ep.errors:.0%}", str(ep.healthy))
+            self.print(table)
+        accuracy = self.tokens.report()
+        if accuracy:
+            table = Table("model", "tokenizer", "samples", "prompt tokens error", "scale")
+            for model, name, samples, error, scale in accuracy:
+                table.add_row(model, name, str(samples), f"{error:.1%}", f"{scale:.3f}" if scale else "-")
+            self.print(table)
+        budgets = self.limiter.report()
+        if budgets:
+            table = Table("host", "model", "requests left", "tokens left")
+            for row in budgets:
+                table.add_row(*row)
+            self.print(table)
+        self.print("Times are in seconds, tps is completion tokens per second after the first token.")
+
+    parser_index = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_index.add_argument("dir", nargs="?", help="directory of documents to index and use for .ask",
+                              completer=cmd2.Cmd.path_complete)
+    @with_argparser(parser_index)
+    def do_index(self, args: Namespace):
+        "Index text files of a directory for .ask, only new and changed files are embedded"
+        import openai
+        if not args.dir:
+            if self.doc_index:
+                idx = self.doc_index
+                self.print(f"Index of {idx.root}: {len(idx.files)} files, {len(idx.chunks)} chunks, model {idx.model}")
+            else:
+                self.print("No index, use .index <dir>")
+            return
+        if not os.path.isdir(args.dir):
+            self.print("Not a directory:", args.dir)
+            return
+        if importlib.util.find_spec("numpy") is None:
+            self.print("Indexing requires numpy: pip install numpy")
+            return
+        index = self.open_index(args.dir)
+        try:
+            with self.console.status("Scanning...") as status:
+                def progress(done, total):
+                    status.update(f"Embedding {done}/{total} chunks...")
+                stats = index.update(self.embed, self.config.embedding_model,
+                                     self.config.index_chunk, self.config.index_batch, progress)
+        except KeyboardInterrupt:
+            self.print("Canceled")
+            return
+        except openai.OpenAIError as e:
+            self.print("OpenAIError:", e)
+            return
+        self.doc_index = index
+        self.print("Indexed {files} files: {changed} changed, {removed} removed, {embedded} chunks embedded".format(**stats))
+
+    parser_ask = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_ask.add_argument("-k", dest="top", type=int, default=5, help="number of chunks to retrieve")
+    parser_ask.add_argument("question", nargs=argparse.REMAINDER, help="question about the indexed documents")
+    @with_argparser(parser_ask)
+    def do_ask(self, args: Namespace):
+        "Ask a question with the most relevant chunks of the indexed documents as context"
+        import openai
+        question = " ".join(args.question)
+        if not self.doc_index:
+            self.print("No index, use .index <dir> first")
+            return
+        if not question:
+            return
+        try:
+            results = self.doc_index.search(self.embed([question])[0], args.top)
+        except openai.OpenAIError as e:
+            self.print("OpenAIError:", e)
+            return
+        docs = "\n\n".join(f"[{rel}]\n{text}" for score, rel, text in results)
+        self.console.log("Context: " + ", ".join(f"{rel} ({score:.2f})" for score, rel, _ in results))
+        context = [{"role": "system", "content": "Answer with the help of these document excerpts:\n\n" + docs}]
+        self.handle_input(question, context)
+
+    parser_search = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_search.add_argument("-r", dest="role", help="only messages of this role, e.g. user or assistant")
+    parser_search.add_argument("-s", dest="since", type=datetime.date.fromisoformat,
+                               help="only sessions saved since this date (YYYY-MM-DD)")
+    parser_search.add_argument("-u", dest="until", type=datetime.date.fromisoformat,
+                               help="only sessions saved before this date (YYYY-MM-DD)")
+    parser_search.add_argument("-n", dest="limit", type=int, default=10, help="max number of results")
+    parser_search.add_argument("-l", dest="load", type=int, metavar="N",
+                               help="load the session of result N of the last search")
+    parser_search.add_argument("query", nargs=argparse.REMAINDER, help="words to search")
+    @with_argparser(parser_search)
+    def do_search(self, args: Namespace):
+        "Search saved and journaled sessions, and load the session of a result"
+        from rich.markup import escape
+        from rich.table import Table
+        if not self.config.search_file:
+            self.print("Search is disabled, set search_file in config")
+            return
+        if args.load is not None:
+            if not 0 < args.load <= len(self.search_results):
+                self.print("No such result:", args.load)
+                return
+            path = self.search_results[args.load - 1][0]
+            mode = SessionIndex.modes.get(os.path.splitext(path)[1], "md")
+            data, _ = SessionIndex.read(path)
+            self.reset_session()
+            self.session.extend(self.parse_session(data, mode))
+            self.print("Load {} records from {}".format(len(self.session), path))
+            return
+        query = " ".join(args.query)
+        if not query:
+            return
+        index = self.get_search()
+        start = time.perf_counter()
+        stats = index.update(dirs=self.config.search_dirs)
+        since = time.mktime(args.since.timetuple()) if args.since else None
+        until = time.mktime(args.until.timetuple()) if args.until else None
+        self.search_results = index.search(query, args.role, since, until, args.limit)
+        elapsed = time.perf_counter() - start
+        if not self.search_results:
+            self.print(f"No results in {stats['files']} sessions ({elapsed * 1000:.0f} ms)")
+            return
+        table = Table("#", "session", "msg", "role", "date", "snippet")
+        for i, (path, idx, role, mtime, snippet) in enumerate(self.search_results, 1):
+            snippet = escape(snippet.replace("\n", " ")).replace("\x02", "[bold yellow]").replace("\x03", "[/]")
+            table.add_row(str(i), os.path.basename(path), str(idx), role,
+                          datetime.date.fromtimestamp(mtime).isoformat(), snippet)
+        self.print(table)
+        self.print(f"{len(self.search_results)} results in {stats['files']} sessions, "
+                   f"{stats['indexed']} indexed ({elapsed * 1000:.0f} ms), .search -l N to load one")
+
+    parser_file = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_file.add_argument("file", help="text file to ask about", completer=cmd2.Cmd.path_complete)
+    parser_file.add_argument("question", nargs=argparse.REMAINDER, help="question about the file")
+    @with_argparser(parser_file)
+    def do_file(self, args: Namespace):
+        "Ask about a file of any size, parts of it are answered concurrently and combined"
+        import openai
+        question = " ".join(args.question) or "Summarize the content."
+        if not os.path.isfile(args.file):
+            self.print("No such file:", args.file)
+            return
+        model = self.config.model
+        budget = self.config.get_budget()
+        overhead = self.tokens.count_messages(model, self.config.prompt) + self.tokens.count(model, question)
+        size = max(256, budget - overhead - budget // 4)
+        parts = self.split_file(args.file, size)
+        first = next(parts, None)
+        if first is None:
+            self.print("Empty file:", args.file)
+            return
+        content = f"{question}\n\n(file: {args.file})"
+        if next(parts, None) is None:
+            parts.close()
+            context = f"Content of the file {os.path.basename(args.file)}:\n\n{first[0]}"
+            self.handle_input(content, [{"role": "system", "content": context}])
+            return
+        parts.close()
+        start = time.perf_counter()
+        try:
+            with self.console.status("Reading...") as status:
+                def progress(pos, total, done, count):
+                    status.update(f"Read {pos / total:.0%} of {args.file}, answered {done}/{count} parts...")
+                answers = self.map_file(args.file, question, size, progress)
+                status.update(f"Combining {len(answers)} answers...")
+                answers = self.reduce_answers(args.file, question, answers, size)
+        except KeyboardInterrupt:
+            self.print("Canceled")
+            return
+        except openai.OpenAIError as e:
+            self.print("OpenAIError:", e)
+            return
+        self.console.log(f"Answered parts of {args.file} in {time.perf_counter() - start:.1f}s")
+        context = (f"Partial answers, each from a part of the file {os.path.basename(args.file)}, "
+                   "combine them into one answer:\n\n" + "\n\n---\n\n".join(answers))
+        self.handle_input(content, [{"role": "system", "content": context}])
+
+    parser_bg = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_bg.add_argument("question", nargs=argparse.REMAINDER, help="question to ask in background")
+    @with_argparser(parser_bg)
+    def do_bg(self, args: Namespace):
+        "Ask in background and keep chatting, see .jobs for the answers"
+        question = " ".join(args.question)
+        if not question:
+            return
+        job = self.submit_job(question)
+        if job is None:
+            self.print(f"Job queue is full ({self.config.jobs_queue}), wait or cancel jobs first")
+            return
+        self.print(f"Job {job.id} submitted")
+
+    parser_jobs = argparse_custom.DEFAULT_ARGUMENT_PARSER()
+    parser_jobs.add_argument("-f", dest="follow", type=int, metavar="ID", help="follow output of a job until it finishes")
+    parser_jobs.add_argument("-c", dest="cancel", type=int, metavar="ID", help="cancel a job")
+    parser_jobs.add_argument("-r", dest="result", type=int, metavar="ID", help="print the answer of a job")
+    @with_argparser(parser_jobs)
+    def do_jobs(self, args: Namespace):
+        "List, follow, cancel background jobs or print their answers"
+        from rich.markdown import Markdown
+        job_id = args.follow or args.cancel or args.result
+        if job_id is None:
+            if not self.jobs:
+                self.print("No jobs, use .bg <question>")
+                return
+            from rich.table import Table
+            table = Table("id", "status", "model", "time", "chars", "question")
+            for job in self.jobs.values():
+                question = job.content if len(job.content) <= 40 else job.content[:37] + "..."
+                table.add_row(str(job.id), job.status, job.model, f"{job.elapsed:.1f}s",
+                              str(len(job.text)), question)
+            self.print(table)
+            return
+        job = self.jobs.get(job_id)
+        if job is None:
+            self.print("No such job:", job_id)
+        elif args.cancel:
+            job.cancel.set()
+            if job.status == "queued":
+                job.finish("canceled")
+            self.print(f"Job {job.id} canceled")
+        elif args.follow:
+            from rich.live import Live
+            try:
+                with Live(console=self.console, refresh_per_second=10,
+                          get_renderable=lambda: Markdown(job.text)) as lv:
+                    while not job.done:
+                        time.sleep(0.1)
+                    lv.refresh()
+            except KeyboardInterrupt:
+                pass
+            self.print(self.sep)
+            if job.error:
+                self.print(f"Job {job.id} {job.status}: {job.error}")
+        elif not job.done:
+            self.print(f"Job {job.id} is {job.status}, use .jobs -f {job.id} to follow it")
+        elif job.error:
+            self.print(f"Job {job.id} {job.status}: {job.error}")
+        else:
+            self.print(Markdown(job.text), self.sep)
 
     parser_usage = argparse_custom.DEFAULT_ARGUMENT_PARSER()
     parser_usage.add_argument("-d", dest="days", type=int,
-                             help="print usage of last n days")
+                             help="print usage of last n days from the local ledger")
     parser_usage.add_argument("-b", dest="billing", action="store_true",
                              help="print detail of the billing subscription")
     @with_argparser(parser_usage)
@@ -374,41 +3423,33 @@ class GptCli(cmd2.Cmd):
         "Tokens usage of current session / last N days, or print detail billing info"
         if args.days is None and not args.billing:
             self.print(f"Total tokens used this session: {self.total_tokens_used}")
+            if isinstance(self.session, SessionStore):
+                self.print("Session: {messages} messages, {bodies} distinct bodies, "
+                           "{memory} bytes in memory, {spilled} bytes on disk".format(**self.session.stats()))
+            return
+        from rich.table import Table
+        if args.days:
+            if not self.config.usage_file:
+                self.print("Usage ledger is disabled, set usage_file in config")
+                return
+            rows = self.get_ledger().daily(args.days)
+            table = Table("day", "model", "requests", "prompt", "completion", "total", "latency(avg)")
+            totals = [0, 0, 0]
+            for day, model, count, prompt, completion, latency in rows:
+                table.add_row(day, model, str(count), str(prompt), str(completion),
+                              str(prompt + completion), f"{latency / count:.2f}s")
+                totals = [totals[0] + count, totals[1] + prompt, totals[2] + completion]
+            table.add_section()
+            table.add_row("total", "", str(totals[0]), str(totals[1]), str(totals[2]), str(totals[1] + totals[2]), "")
+            self.print(table)
             return
+        import requests
         headers = {"Authorization": f"Bearer {self.config.api_key}"}
         proxies = {}
         if self.config.proxy:
             proxies["http"] = self.config.proxy
             proxies["https"] = self.config.proxy
-        if args.days:
-            end_date = datetime.datetime.now()
-            start_date = end_date - datetime.timedelta(args.days)
-            url = f"{self.config.base_url}/dashboard/billing/usage"
-            params = {
-                "start_date": str(start_date.date()),
-                "end_date": str(end_date.date()),
-            }
-            resp = requests.get(url, params=params, headers=headers, proxies=proxies)
-            if resp.status_code != 200 or "json" not in resp.headers["content-type"]:
-                self.print("Failed to get usage:", resp.status_code, resp.text)
-                return
-            js = resp.json()
-            daily_costs = js.get("daily_costs")
-            if not daily_costs:
-                self.print("json error:", js)
-                return
-            table = Table()
-            for i, cost in enumerate(daily_costs):
-                line_items = cost.get("line_items", [])
-                if i == 0:
-                    table.add_column("time")
-                    for item in line_items:
-                        table.add_column(item["name"])
-                row = [datetime.datetime.fromtimestamp(cost["timestamp"])] + [item["cost"] for item in line_items]
-                table.add_row(*list(map(str, row)))
-            self.print(table)
-            self.print("total_usage", js.get("total_usage"))
-        elif args.billing:
+        if args.billing:
             url = f"{self.config.base_url}/dashboard/billing/subscription"
             resp = requests.get(url, headers=headers, proxies=proxies)
             self.console.print_json(resp.text)
@@ -416,7 +3457,65 @@ class GptCli(cmd2.Cmd):
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-c", dest="config", help="path to config.json", default=Config.default)
+    parser.add_argument("-q", dest="question", help="ask a single question and exit, without the interactive console")
+    parser.add_argument("--batch", metavar="IN", help="run requests of jsonl file (or - for stdin) in batch mode")
+    parser.add_argument("--out", metavar="OUT", help="jsonl file to append batch results")
+    parser.add_argument("-j", dest="concurrency", type=int, default=4, help="concurrent requests in batch mode")
+    parser.add_argument("--retries", type=int, default=3, help="retries of failed request in batch mode")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", help="serve an OpenAI-compatible API for other clients")
+    parser.add_argument("--raw", action="store_true",
+                        help="read the question from stdin and write the answer unrendered, "
+                             "the default if stdin or stdout is not a terminal")
+    parser.add_argument("--json", action="store_true", help="write NDJSON events with timings in raw mode")
     args = parser.parse_args()
+    if args.batch and not args.out:
+        parser.error("--out is required in batch mode")
+
+    if args.serve:
+        import asyncio
+        host, _, port = args.serve.rpartition(":")
+        chat = Chat(args.config)
+        try:
+            asyncio.run(Gateway(chat).serve(host or "127.0.0.1", int(port)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            chat.close()
+        return
+
+    if not args.batch and (args.raw or args.json or not sys.stdin.isatty() or not sys.stdout.isatty()):
+        content = args.question or ""
+        mode = os.fstat(sys.stdin.fileno()).st_mode
+        if not content or stat.S_ISFIFO(mode) or stat.S_ISREG(mode):
+            # a question from -q gets piped input appended, e.g. `cat log | gptcli.py -q summarize`
+            data = sys.stdin.read()
+            content = f"{content}\n\n{data}" if content else data
+        if not content.strip():
+            parser.error("nothing to ask, pass a question with -q or on stdin")
+        chat = Chat(args.config, verbose=False, stderr=True)
+        out = os.fdopen(sys.stdout.fileno(), "wb", buffering=0, closefd=False)
+        try:
+            ok = chat.query_raw(content, out, args.json)
+        except BrokenPipeError:
+            # reader of the pipe is gone, e.g. `| head`
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            ok = True
+        except KeyboardInterrupt:
+            ok = False
+        finally:
+            chat.close()
+        sys.exit(0 if ok else 1)
+
+    if args.question or args.batch:
+        chat = Chat(args.config, verbose=False)
+        try:
+            if args.batch:
+                chat.run_batch(args.batch, args.out, args.concurrency, args.retries)
+            else:
+                chat.handle_input(args.question)
+        finally:
+            chat.close()
+        return
 
     app = GptCli(args.config)
     app.cmdloop()
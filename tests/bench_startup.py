@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Measure startup time of gptcli.py, and check that heavy modules are not
+imported until a feature needs them.
+
+    python3 tests/bench_startup.py -n 10 --max-ms 800
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+LAZY_MODULES = ["openai", "httpx", "requests", "tiktoken", "rich.markdown", "rich.live"]
+
+
+def import_times(module="gptcli"):
+    """Run `python -X importtime` and return {module: (cumulative us, depth)}"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times[name.strip()] = (int(cumulative), depth)
+    return times
+
+
+def wall_time(args, runs):
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, capture_output=True, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", dest="runs", type=int, default=5, help="runs of each measurement, best is reported")
+    parser.add_argument("--max-ms", type=float, help="fail if `gptcli.py -h` is slower than this")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show")
+    args = parser.parse_args()
+
+    times = import_times()
+    print(f"import gptcli: {times['gptcli'][0] / 1000:.1f} ms")
+    direct = {k: us for k, (us, depth) in times.items() if depth == 1}
+    for name, us in sorted(direct.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"  {name:<30} {us / 1000:8.1f} ms")
+
+    eager = [m for m in LAZY_MODULES if m in times]
+    if eager:
+        print("modules that should be lazy:", ", ".join(eager))
+
+    elapsed = wall_time(["gptcli.py", "-h"], args.runs) * 1000
+    print(f"gptcli.py -h: {elapsed:.1f} ms (best of {args.runs})")
+    if eager or (args.max_ms and elapsed > args.max_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the chat client against the local mock server, it
+drives `handle_input` in stream (with and without markdown rendering) and
+non-stream mode, and reports client overhead per chunk, CPU time spent in
+rendering, peak memory, and time-to-first-token and time-to-last-token
+overhead. Rendering runs apart from reading in stream mode, so the last
+token overhead stays low even when the total wall time is bound by the
+renderer.
+
+    python3 tests/bench_stream.py --length 20000 --chunk 4 --max-chunk-ms 2
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from rich.console import Console
+from mock_server import MockServer, MockOptions
+import gptcli
+
+SCENARIOS = {
+    "stream+render": {"stream": True, "stream_render": True},
+    "stream": {"stream": True, "stream_render": False},
+    "no-stream": {"stream": False, "stream_render": False},
+}
+
+
+class WordEncoding:
+    """Stand-in for tiktoken, which may download BPE files on first use"""
+    name = "words"
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+def make_chat(base_url: str, model: str, settings: dict) -> gptcli.Chat:
+    config = {
+        "api_key": "sk-mock",
+        "base_url": base_url,
+        "model": model,
+        "context": 0,
+        "prewarm": False,
+        "cache": False,
+        **settings,
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(config, f)
+    try:
+        chat = gptcli.Chat(f.name, verbose=False)
+    finally:
+        os.unlink(f.name)
+    chat.console = Console(file=io.StringIO(), force_terminal=True, width=100)
+    chat.tokens.encoders[model] = WordEncoding()
+    return chat
+
+
+def run_once(chat: gptcli.Chat, opts: MockOptions) -> dict:
+    chunks = -(-opts.length // opts.chunk)
+    server_time = opts.first_delay + opts.interval * (chunks - 1)
+    chat.console.file = io.StringIO()
+    cpu, wall = time.process_time(), time.perf_counter()
+    chat.handle_input("benchmark")
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    record = chat.metrics.last
+    return {
+        "wall": wall,
+        "chunk_ms": (wall - server_time) / chunks * 1000,
+        "ttft_ms": (record["ttft"] - opts.first_delay) * 1000,
+        "ttlt_ms": (record["total"] - server_time) * 1000,
+        "render": record["render"],
+        "cpu": cpu,
+    }
+
+
+def peak_memory(chat: gptcli.Chat) -> float:
+    """Peak memory in MB of a request, measured apart as tracing slows it down"""
+    chat.console.file = io.StringIO()
+    tracemalloc.start()
+    chat.handle_input("benchmark")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", dest="runs", type=int, default=3, help="runs of each scenario, median is reported")
+    parser.add_argument("--chunk", type=int, default=8, help="characters per chunk")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between chunks")
+    parser.add_argument("--length", type=int, default=8000, help="characters of the answer")
+    parser.add_argument("--first-delay", type=float, default=0.05, help="seconds before the first chunk")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), action="append", help="scenario to run (default: all)")
+    parser.add_argument("--max-chunk-ms", type=float, default=5.0, help="fail if client overhead per chunk is above")
+    parser.add_argument("--max-ttft-ms", type=float, default=100.0, help="fail if time-to-first-token overhead is above")
+    args = parser.parse_args()
+
+    opts = MockOptions(args.chunk, args.interval, args.length, args.first_delay)
+    server = MockServer(opts).start()
+    failed = []
+    print(f"{'scenario':<14} {'wall(s)':>8} {'chunk(ms)':>10} {'ttft(ms)':>9} {'ttlt(ms)':>9} "
+          f"{'render(s)':>10} {'cpu(s)':>7} {'peak(MB)':>9}")
+    for name in args.scenario or SCENARIOS:
+        chat = make_chat(server.base_url, "gpt-mock", SCENARIOS[name])
+        results = [run_once(chat, opts) for _ in range(args.runs)]
+        r = {k: statistics.median(x[k] for x in results) for k in results[0]}
+        r["peak_mb"] = peak_memory(chat)
+        chat.close()
+        print(f"{name:<14} {r['wall']:>8.3f} {r['chunk_ms']:>10.3f} {r['ttft_ms']:>9.1f} {r['ttlt_ms']:>9.1f} "
+              f"{r['render']:>10.3f} {r['cpu']:>7.3f} {r['peak_mb']:>9.2f}")
+        if SCENARIOS[name]["stream"] and r["chunk_ms"] > args.max_chunk_ms:
+            failed.append(f"{name}: {r['chunk_ms']:.3f} ms per chunk > {args.max_chunk_ms}")
+        if r["ttft_ms"] > args.max_ttft_ms:
+            failed.append(f"{name}: {r['ttft_ms']:.1f} ms ttft overhead > {args.max_ttft_ms}")
+    server.shutdown()
+    for msg in failed:
+        print("FAIL", msg)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for an OpenAI-compatible API, it answers
+`/v1/chat/completions` with a generated markdown text, as SSE stream or as a
+single json response, and `/v1/embeddings` with hashed bag-of-words vectors. Chunk size, rate and length are configurable, so
+the client can be measured without network access. With `--rpm` the chat
+requests are rate limited like the real API, with x-ratelimit-* headers and
+429 errors with retry-after.
+
+    python3 tests/mock_server.py --port 8000 --chunk 8 --interval 0.005 --length 20000
+"""
+
+import json
+import time
+import zlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PARAGRAPH = ("Lorem ipsum dolor sit amet, **consectetur** adipiscing elit, sed do eiusmod "
+             "tempor incididunt ut labore et dolore magna aliqua. Ut enim ad `minim` veniam.\n\n")
+CODE = "```python\ndef welcome(name):\n    print(f\"Hello, {name}!\")\n\nwelcome(\"Alice\")\n```\n\n"
+LIST = "- first item\n- second item with *emphasis*\n- third item\n\n"
+
+
+def make_text(length: int) -> str:
+    """Markdown text of given length, with paragraphs, code blocks and lists"""
+    parts, size, i = [], 0, 0
+    blocks = [PARAGRAPH, CODE, PARAGRAPH, LIST]
+    while size < length:
+        block = blocks[i % len(blocks)]
+        parts.append(block)
+        size += len(block)
+        i += 1
+    return "".join(parts)[:length]
+
+
+class MockOptions:
+    def __init__(self, chunk=8, interval=0.0, length=4000, first_delay=0.0, rpm=0):
+        self.chunk = chunk              # characters per chunk
+        self.interval = interval        # seconds between chunks
+        self.length = length            # characters of the answer
+        self.first_delay = first_delay  # seconds before the first chunk
+        self.rpm = rpm                  # requests per minute, 0 for no limit
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        size = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(size))
+        opts: MockOptions = self.server.options
+        self.server.requests += 1
+        if self.path.endswith("/embeddings"):
+            return self.embeddings(body)
+        self.limits = self.server.take()
+        if self.limits is None:
+            return self.reject()
+        text = make_text(opts.length)
+        if body.get("stream"):
+            self.stream(body["model"], text, opts)
+        else:
+            time.sleep(opts.first_delay + opts.interval * (len(text) // opts.chunk))
+            data = json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": len(text) // 4,
+                          "total_tokens": 10 + len(text) // 4},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_limits()
+            self.end_headers()
+            self.wfile.write(data)
+
+    def send_limits(self):
+        for name, value in self.limits.items():
+            self.send_header(name, value)
+
+    def reject(self):
+        self.server.rejected += 1
+        wait = self.server.retry_after()
+        data = json.dumps({"error": {"message": "Rate limit reached", "type": "requests",
+                                     "code": "rate_limit_exceeded"}}).encode()
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("retry-after-ms", str(int(wait * 1000)))
+        self.send_header("retry-after", str(int(wait) + 1))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def embeddings(self, body: dict):
+        """Bag of hashed words, so texts sharing words are similar"""
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(inputs):
+            vector = [0.0] * 64
+            for word in text.lower().split():
+                vector[zlib.crc32(word.encode()) % 64] += 1.0
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        out = json.dumps({"object": "list", "data": data, "model": body["model"],
+                          "usage": {"prompt_tokens": 0, "total_tokens": 0}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def stream(self, model: str, text: str, opts: MockOptions):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_limits()
+        self.end_headers()
+
+        def send(data: str):
+            event = f"data: {data}\n\n".encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+
+        def chunk(delta: dict, finish_reason=None):
+            return json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        time.sleep(opts.first_delay)
+        send(chunk({"role": "assistant", "content": ""}))
+        for i in range(0, len(text), opts.chunk):
+            if i and opts.interval:
+                time.sleep(opts.interval)
+            send(chunk({"content": text[i:i + opts.chunk]}))
+        send(chunk({}, "stop"))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options: MockOptions, port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.options = options
+        self.requests = 0
+        self.rejected = 0
+        self.budget = float(options.rpm)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        rpm = self.options.rpm
+        self.budget = min(rpm, self.budget + rpm / 60 * (now - self.stamp))
+        self.stamp = now
+
+    def take(self):
+        """Headers of the rate limit after taking a request, None if the budget is used up"""
+        rpm = self.options.rpm
+        if not rpm:
+            return {}
+        with self.lock:
+            self.refill()
+            if self.budget < 1:
+                return None
+            self.budget -= 1
+            reset = (rpm - self.budget) * 60 / rpm
+            return {"x-ratelimit-limit-requests": str(rpm),
+                    "x-ratelimit-remaining-requests": str(int(self.budget)),
+                    "x-ratelimit-reset-requests": f"{reset:.3f}s"}
+
+    def retry_after(self) -> float:
+        with self.lock:
+            self.refill()
+            return max(1 - self.budget, 0) * 60 / self.options.rpm
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--chunk", type=int, default=8, help="characters per chunk")
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between chunks")
+    parser.add_argument("--length", type=int, default=4000, help="characters of the answer")
+    parser.add_argument("--first-delay", type=float, default=0.2, help="seconds before the first chunk")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute, 0 for no limit")
+    args = parser.parse_args()
+    server = MockServer(MockOptions(args.chunk, args.interval, args.length, args.first_delay, args.rpm),
+                        args.port)
+    print("serving on", server.base_url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import zlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from gptcli import DocIndex
+
+
+def embed(texts):
+    """Bag of hashed words, like the mock server"""
+    vectors = []
+    for text in texts:
+        vector = [0.0] * 16
+        for word in text.lower().split():
+            vector[zlib.crc32(word.encode()) % 16] += 1.0
+        vectors.append(vector)
+    return vectors
+
+
+def write(root, name, text):
+    with open(os.path.join(root, name), "w") as f:
+        f.write(text)
+
+
+def reindex(root, path):
+    return DocIndex(root, path).update(embed, "m", 100, 8)
+
+
+def test_delete_and_empty():
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as path:
+        write(root, "a.txt", "apples and pears\n" * 10)
+        write(root, "b.txt", "boats and trains\n" * 10)
+        stats = reindex(root, path)
+        assert stats["embedded"] > 0
+
+        os.remove(os.path.join(root, "b.txt"))
+        stats = reindex(root, path)
+        assert (stats["removed"], stats["embedded"]) == (1, 0)
+        index = DocIndex(root, path)
+        assert {rel for rel, _, _ in index.chunks} == {"a.txt"}
+        assert index.search(embed(["apples"])[0], k=1)[0][1] == "a.txt"
+
+        write(root, "a.txt", "  \n")
+        os.utime(os.path.join(root, "a.txt"), (0, 0))
+        stats = reindex(root, path)
+        assert (stats["changed"], stats["embedded"]) == (1, 0)
+        index = DocIndex(root, path)
+        assert index.chunks == [] and index.search(embed(["apples"])[0]) == []
+
+        write(root, "c.txt", "cars and roads\n")
+        reindex(root, path)
+        assert DocIndex(root, path).search(embed(["cars"])[0], k=1)[0][1] == "c.txt"
+
+
+if __name__ == "__main__":
+    test_delete_and_empty()
+    print("ok")
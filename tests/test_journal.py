@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from gptcli import SessionJournal
+
+
+def message(i):
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} 你好"}
+
+
+def test_partial_line_and_pop():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "session.jsonl")
+        journal = SessionJournal(path)
+        journal.extend(message(i) for i in range(5))
+        journal.close()
+
+        # crashed while writing a message
+        with open(path, "ab") as f:
+            f.write(b'{"role": "user", "con')
+        journal = SessionJournal(path)
+        assert list(journal) == [message(i) for i in range(5)]
+        journal.append(message(5))
+        assert journal.pop() == message(5)
+        assert journal.pop() == message(4)
+        journal.close()
+
+        journal = SessionJournal(path)
+        assert list(journal) == [message(i) for i in range(4)]
+        with open(path, "rb") as f:
+            assert f.read().endswith(b"\n")
+        for op in (lambda: journal.insert(0, message(9)), lambda: journal.__setitem__(0, message(9)),
+                   lambda: journal.__delitem__(0)):
+            try:
+                op()
+            except TypeError:
+                pass
+            else:
+                raise AssertionError("journal is append-only")
+        journal.close()
+
+        # the index is rebuilt when it's missing
+        os.remove(path + ".idx")
+        journal = SessionJournal(path)
+        assert list(journal) == [message(i) for i in range(4)]
+        journal.close()
+
+
+if __name__ == "__main__":
+    test_partial_line_and_pop()
+    print("ok")